@@ -0,0 +1,95 @@
+# cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Cache LRU en mémoire, thread-safe, borné en nombre d'entrées
+    et/ou en octets (poids de chaque valeur calculé par `weigh`).
+    ttl : durée de vie optionnelle des entrées, en secondes.
+    """
+
+    def __init__(self, maxsize: int = 1024, max_bytes: int = None, weigh=len, ttl: float = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._weigh = weigh
+        self._data = OrderedDict()
+        self._weights = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data and self.ttl is not None and self._expires[key] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        weight = self._weigh(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and weight > self.max_bytes:
+            return  # Trop gros pour le budget : jamais mis en cache
+        with self._lock:
+            self._remove(key)
+            self._data[key] = value
+            self._weights[key] = weight
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            self.bytes += weight
+            while (self.maxsize is not None and len(self._data) > self.maxsize) or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key]
+            self._remove(key)
+            return value
+
+    def _remove(self, key):
+        if key in self._data:
+            del self._data[key]
+            self._expires.pop(key, None)
+            self.bytes -= self._weights.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self._expires.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "ttl": self.ttl,
+            "expirations": self.expirations,
+        }
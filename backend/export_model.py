@@ -0,0 +1,143 @@
+# export_model.py
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from io import BytesIO
+
+import gridfs
+from dotenv import load_dotenv
+from PIL import Image
+from pymongo import MongoClient
+from ultralytics import YOLO
+
+from inference import BACKENDS, load_backend, quantize_onnx, resolve_weights
+
+
+def export(model_path: str, fmt: str, int8: bool, data: str = None) -> str:
+    """
+    Exporte best.pt vers ONNX ou OpenVINO (optionnellement quantifié INT8)
+    et renvoie le chemin attendu par load_backend.
+    """
+    target = resolve_weights(fmt, model_path, int8)
+    model = YOLO(model_path, task="classify")
+
+    if fmt == "onnx":
+        exported = model.export(format="onnx", dynamic=True, simplify=True)
+        plain = resolve_weights("onnx", model_path, False)
+        if os.path.abspath(exported) != os.path.abspath(plain):
+            shutil.move(exported, plain)
+        if int8:
+            quantize_onnx(plain, target)
+    elif fmt == "openvino":
+        # Forme dynamique, comme ONNX : le moteur envoie des lots jusqu'à BATCH_MAX_SIZE images
+        kwargs = {"format": "openvino", "int8": int8, "dynamic": True}
+        if int8:
+            if not data:
+                raise SystemExit("La quantification INT8 OpenVINO nécessite --data (jeu de calibration).")
+            kwargs["data"] = data
+        exported = model.export(**kwargs)
+        if os.path.abspath(exported) != os.path.abspath(target):
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.move(exported, target)
+    else:
+        raise SystemExit(f"Format d'export non supporté : {fmt}")
+
+    print(f"Exporté {model_path} → {target}")
+    return target
+
+
+def load_validated_images(limit: int):
+    """
+    Charge les images dont l'étiquette est connue (tests ou validées par vote).
+    """
+    load_dotenv()
+    client = MongoClient(os.getenv("ATLAS_URI"))
+    db = client[os.getenv("DB_NAME")]
+    fs = gridfs.GridFS(db)
+
+    query = {"ground_truth": {"$ne": None}}
+    images = []
+    for doc in db["images"].find(query, {"file_id": 1, "data": 1, "ground_truth": 1}).limit(limit):
+        try:
+            # Original inline (BinData) ou dans GridFS
+            data = bytes(doc["data"]) if doc.get("data") is not None else fs.get(doc["file_id"]).read()
+        except gridfs.errors.NoFile:
+            continue
+        images.append((Image.open(BytesIO(data)).convert("RGB"), doc["ground_truth"]))
+    return images
+
+
+def parity_check(model_path: str, fmt: str, int8: bool, limit: int, batch_size: int):
+    """
+    Compare le top-1 du backend exporté à celui du modèle PyTorch d'origine.
+    """
+    reference = load_backend("torch", model_path)
+    candidate = load_backend(fmt, model_path, int8)
+    if reference.labels != candidate.labels:
+        raise SystemExit(f"Étiquettes différentes : {reference.labels} ≠ {candidate.labels}")
+
+    samples = load_validated_images(limit)
+    if not samples:
+        raise SystemExit("Aucune image validée pour le contrôle de parité.")
+
+    agree = ref_correct = cand_correct = 0
+    ref_time = cand_time = 0.0
+    for i in range(0, len(samples), batch_size):
+        batch = samples[i:i + batch_size]
+        imgs = [img for img, _ in batch]
+
+        t0 = time.perf_counter()
+        ref_labels = reference.predict_labels(imgs)
+        ref_time += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        cand_labels = candidate.predict_labels(imgs)
+        cand_time += time.perf_counter() - t0
+
+        for (_, truth), r, c in zip(batch, ref_labels, cand_labels):
+            agree += r == c
+            ref_correct += r == truth
+            cand_correct += c == truth
+
+    n = len(samples)
+    report = {
+        "images": n,
+        "top1_agreement": agree / n,
+        "accuracy_torch": ref_correct / n,
+        f"accuracy_{candidate.name}": cand_correct / n,
+        "speedup": ref_time / cand_time if cand_time else None,
+    }
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export et contrôle de parité du modèle YOLO")
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "best.pt"))
+    parser.add_argument("--format", choices=[b for b in BACKENDS if b != "torch"], default="onnx")
+    parser.add_argument("--int8", action="store_true", help="Quantification INT8")
+    parser.add_argument("--data", help="Jeu de calibration (requis pour OpenVINO INT8)")
+    parser.add_argument("--skip-export", action="store_true", help="Contrôle de parité seulement")
+    parser.add_argument("--check", action="store_true", help="Contrôle de parité sur les images validées")
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    args = parser.parse_args()
+
+    if not args.skip_export:
+        export(args.model, args.format, args.int8, args.data)
+
+    if args.check or args.skip_export:
+        report = parity_check(args.model, args.format, args.int8, args.limit, args.batch_size)
+        if report["top1_agreement"] < args.min_agreement:
+            print(f"❌ Accord top-1 < {args.min_agreement}")
+            sys.exit(1)
+        print("✅ Parité OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+# inference.py
+
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from metrics import Histogram
+
+
+BACKENDS = ("torch", "onnx", "openvino")
+
+
+# --- Backends d'inférence ---
+def resolve_weights(backend: str, model_path: str, int8: bool = False) -> str:
+    """
+    Chemin des poids à charger pour un backend donné, à partir de best.pt :
+    best.pt, best.onnx / best_int8.onnx, best_openvino_model/ / best_int8_openvino_model/
+    """
+    stem = os.path.splitext(model_path)[0]
+    suffix = "_int8" if int8 else ""
+    if backend == "torch":
+        return model_path
+    if backend == "onnx":
+        return f"{stem}{suffix}.onnx"
+    if backend == "openvino":
+        return f"{stem}{suffix}_openvino_model"
+    raise ValueError(f"Backend inconnu : {backend} (attendu : {', '.join(BACKENDS)})")
+
+
+def compute_model_version(path: str) -> str:
+    """
+    Version du modèle = empreinte SHA-256 (tronquée) du fichier de poids
+    (ou de tous les fichiers d'un dossier exporté, ex. OpenVINO).
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    else:
+        files = [path]
+
+    h = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def model_version_tag(backend: str, model_path: str, int8: bool = False) -> str:
+    """
+    Version enregistrée avec les prédictions : backend, quantification et empreinte des poids.
+    """
+    weights = resolve_weights(backend, model_path, int8)
+    return f"{backend}{'-int8' if int8 else ''}-{compute_model_version(weights)}"
+
+
+class YoloBackend:
+    """
+    Backend de classification YOLOv8. Ultralytics choisit le moteur d'exécution
+    selon le format des poids : PyTorch (.pt), ONNX Runtime (.onnx) ou OpenVINO (dossier).
+    """
+
+    def __init__(self, name: str, weights: str):
+        from ultralytics import YOLO
+
+        if not os.path.exists(weights):
+            raise RuntimeError(f"Poids introuvables pour le backend '{name}' : {weights}")
+        self.name = name
+        self.weights = weights
+        self.model = YOLO(weights, task="classify")
+        # Les étiquettes viennent du modèle lui-même : toujours alignées sur les sorties
+        self.labels = [self.model.names[i] for i in sorted(self.model.names)]
+
+    def predict_probs(self, images: list):
+        """
+        Probabilités par classe pour chaque image du lot (None si pas de sortie).
+        """
+        results = self.model(images, verbose=False)
+        return [
+            r.probs.data.tolist() if r.probs is not None else None
+            for r in results
+        ]
+
+    def predict_labels(self, images: list):
+        return [
+            self.labels[max(range(len(p)), key=p.__getitem__)] if p is not None else None
+            for p in self.predict_probs(images)
+        ]
+
+    def predict_top_k(self, images: list, k: int):
+        """
+        Les k classes les plus probables de chaque image : [(étiquette, probabilité), ...].
+        """
+        return [
+            sorted(zip(self.labels, p), key=lambda lp: lp[1], reverse=True)[:k] if p is not None else []
+            for p in self.predict_probs(images)
+        ]
+
+
+def decode_image(data: bytes):
+    from PIL import Image
+
+    return Image.open(BytesIO(data)).convert("RGB")
+
+
+def load_backend(name: str, model_path: str, int8: bool = False) -> YoloBackend:
+    return YoloBackend(name, resolve_weights(name, model_path, int8))
+
+
+def quantize_onnx(src: str, dst: str):
+    """
+    Quantification dynamique INT8 d'un modèle ONNX (poids en UInt8).
+    Les métadonnées ultralytics (noms des classes, taille d'entrée) sont recopiées.
+    """
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    src_model = onnx.load(src)
+    dst_model = onnx.load(dst)
+    del dst_model.metadata_props[:]
+    dst_model.metadata_props.extend(src_model.metadata_props)
+    onnx.save(dst_model, dst)
+
+
+# --- Pool de processus d'inférence ---
+_worker_backend = None
+
+
+def _init_worker(backend_name: str, model_path: str, int8: bool, num_threads: int):
+    """
+    Initialisation d'un processus d'inférence : threads torch fixés, modèle chargé une fois.
+    """
+    global _worker_backend
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+
+    import torch
+
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    _worker_backend = load_backend(backend_name, model_path, int8)
+
+
+def _worker_labels():
+    return _worker_backend.labels
+
+
+def _read_shared(refs):
+    payloads = []
+    for name, size in refs:
+        shm = SharedMemory(name=name)
+        # Le bloc appartient au processus API, qui se charge de le libérer
+        resource_tracker.unregister(shm._name, "shared_memory")
+        try:
+            payloads.append(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+    return payloads
+
+
+def _worker_predict(refs):
+    images = [decode_image(data) for data in _read_shared(refs)]
+    return _worker_backend.predict_labels(images)
+
+
+def _worker_top_k(images, k):
+    # Images déjà décodées par l'appelant (PIL, transmises par pickle)
+    return _worker_backend.predict_top_k(images, k)
+
+
+class InferencePool:
+    """
+    Pool de processus d'inférence isolés des threads de requêtes.
+    Les images (octets encodés) transitent par des blocs de mémoire partagée.
+    Un processus mort casse le pool : il est alors recréé (les lots en cours échouent).
+    """
+
+    def __init__(self, workers: int, backend_name: str, model_path: str,
+                 int8: bool = False, num_threads: int = 1):
+        self.workers = workers
+        self._initargs = (backend_name, model_path, int8, num_threads)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = self._spawn()
+        self.labels = self._executor.submit(_worker_labels).result()
+
+    def _spawn(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    def _respawn(self, broken):
+        with self._lock:
+            if self._closed or self._executor is not broken:
+                return  # déjà recréé par un autre appel
+            self._executor = self._spawn()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args) -> Future:
+        executor = self._executor
+        try:
+            fut = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._respawn(executor)
+            executor = self._executor
+            fut = executor.submit(fn, *args)
+        def check(f):
+            # Processus mort pendant le lot : le prochain appel trouvera un pool neuf
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                self._respawn(executor)
+
+        fut.add_done_callback(check)
+        return fut
+
+    def predict_batch(self, payloads: list) -> Future:
+        blocks, refs = [], []
+
+        def release(_=None):
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        try:
+            for data in payloads:
+                shm = SharedMemory(create=True, size=max(1, len(data)))
+                blocks.append(shm)
+                shm.buf[:len(data)] = data
+                refs.append((shm.name, len(data)))
+            fut = self._submit(_worker_predict, refs)
+        except BaseException:
+            release()  # pas de Future : les blocs ne seraient jamais libérés
+            raise
+        fut.add_done_callback(release)
+        return fut
+
+    def predict_top_k(self, images: list, k: int) -> Future:
+        return self._submit(_worker_top_k, images, k)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# --- Micro-batching ---
+class InferenceEngine:
+    """
+    Regroupe les demandes de prédiction concurrentes en lots (taille max ou
+    délai max atteint) et exécute une seule passe du modèle par lot.
+    Chaque appelant reçoit son propre résultat via un Future.
+
+    predict_batch peut renvoyer directement les résultats ou un Future
+    (pool de processus) : jusqu'à max_inflight lots sont alors traités en parallèle.
+    """
+
+    def __init__(self, predict_batch, max_batch_size: int = 8, max_wait_ms: float = 10.0,
+                 max_inflight: int = 1):
+        self._predict_batch = predict_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._inflight = threading.BoundedSemaphore(max(1, max_inflight))
+
+        self.batch_size_hist = Histogram(
+            "inference_batch_size",
+            buckets=(1, 2, 4, 8, 16, 32, 64),
+            description="Nombre d'images par passe du modèle",
+        )
+        self.queue_wait_hist = Histogram(
+            "inference_queue_wait_seconds",
+            buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+            description="Temps d'attente dans la file avant inférence",
+        )
+        self.latency_hist = Histogram(
+            "inference_latency_seconds",
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+            description="Durée d'une passe du modèle (lot complet, pool compris)",
+        )
+
+        self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image) -> Future:
+        fut = Future()
+        self._queue.put((image, fut, time.perf_counter()))
+        return fut
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            # Attend qu'un exécuteur soit libre : les requêtes s'accumulent en lot entre-temps
+            self._inflight.acquire()
+            first = self._queue.get()
+            batch = [first]
+            deadline = first[2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        now = time.perf_counter()
+        for _, _, enqueued in batch:
+            self.queue_wait_hist.observe(now - enqueued)
+        self.batch_size_hist.observe(len(batch))
+
+        try:
+            results = self._predict_batch([image for image, _, _ in batch])
+        except Exception as e:
+            self._deliver(batch, now, error=e)
+            return
+
+        if isinstance(results, Future):
+            results.add_done_callback(lambda f: self._deliver_future(batch, now, f))
+        else:
+            self._deliver(batch, now, results)
+
+    def _deliver_future(self, batch, started, f: Future):
+        # Future annulé (arrêt du pool) : f.exception() lèverait CancelledError
+        if f.cancelled():
+            self._deliver(batch, started, error=RuntimeError("Inférence annulée"))
+        elif f.exception() is not None:
+            self._deliver(batch, started, error=f.exception())
+        else:
+            self._deliver(batch, started, f.result())
+
+    def _deliver(self, batch, started, results=None, error=None):
+        self.latency_hist.observe(time.perf_counter() - started)
+        self._inflight.release()
+        for i, (_, fut, _) in enumerate(batch):
+            try:
+                if error is not None:
+                    fut.set_exception(error)
+                else:
+                    fut.set_result(results[i])
+            except InvalidStateError:
+                pass  # appelant parti (Future annulé) : les autres reçoivent leur résultat
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self.queue_depth(),
+            "batch_size": self.batch_size_hist.snapshot(),
+            "queue_wait_seconds": self.queue_wait_hist.snapshot(),
+            "latency_seconds": self.latency_hist.snapshot(),
+        }
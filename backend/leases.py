@@ -0,0 +1,66 @@
+# leases.py
+
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+
+class LeaseManager:
+    """
+    File d'attribution des images à annoter, par baux (leases) à durée limitée.
+
+    Les baux actifs d'une image sont stockés dans son document (`leases`), ce qui
+    permet de purger les baux expirés, vérifier le plafond et réserver en une
+    seule mise à jour atomique, quel que soit le nombre de réplicas du backend.
+    Le plafond correspond au nombre de votes encore nécessaires pour valider l'image.
+    """
+
+    def __init__(self, images_col, ttl_seconds: int, vote_threshold: float, min_weight: float):
+        self.images_col = images_col
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.vote_threshold = vote_threshold
+        self.min_weight = min_weight
+
+    def _votes_needed(self):
+        # ceil((seuil - poids déjà reçu) / poids minimal d'un vote), au moins 1
+        return {"$max": [1, {"$ceil": {"$divide": [
+            {"$subtract": [self.vote_threshold, {"$ifNull": ["$vote_total", 0]}]},
+            self.min_weight
+        ]}}]}
+
+    async def claim(self, image_oid, user_id: str) -> bool:
+        """
+        Réserve l'image pour l'utilisateur. Renvoie False si le plafond de baux
+        actifs est atteint (l'image est déjà confiée à assez d'annotateurs).
+        """
+        now = datetime.utcnow()
+        doc = await self.images_col.find_one_and_update(
+            {"_id": image_oid},
+            [
+                # Baux encore valides des autres utilisateurs
+                {"$set": {"leases": {"$filter": {
+                    "input": {"$ifNull": ["$leases", []]},
+                    "cond": {"$and": [
+                        {"$gt": ["$$this.expires_at", now]},
+                        {"$ne": ["$$this.user_id", user_id]}
+                    ]}
+                }}}},
+                # Ajout (ou renouvellement) du bail si le plafond le permet
+                {"$set": {"leases": {"$cond": [
+                    {"$lt": [{"$size": "$leases"}, self._votes_needed()]},
+                    {"$concatArrays": ["$leases", [{"user_id": user_id, "expires_at": now + self.ttl}]]},
+                    "$leases"
+                ]}}},
+            ],
+            projection={"leases.user_id": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return bool(doc) and any(lease.get("user_id") == user_id for lease in doc.get("leases", []))
+
+    @staticmethod
+    def release_update(user_id: str) -> dict:
+        """
+        Fragment de mise à jour libérant le bail de l'utilisateur (à combiner
+        avec les autres opérations sur le document image).
+        """
+        return {"$pull": {"leases": {"user_id": user_id}}}
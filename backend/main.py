@@ -1,53 +1,135 @@
 import os
-from io import BytesIO
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
 from datetime import datetime
 import time
-from typing import Optional
-import base64
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional
+import mimetypes
+import re
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from bson import ObjectId
 import gridfs
 from dotenv import load_dotenv
 from collections import defaultdict
 import random
-from PIL import Image
-import random
-from ultralytics import YOLO
+from cache import LRUCache
+from progress import ProgressIndex
+from leases import LeaseManager
+from metrics import MongoCommandMetrics, MongoPoolMetrics, Registry, log_event
+from profiling import ProfiledRoute, RequestProfiler, span
+from inference import (
+    InferenceEngine,
+    InferencePool,
+    decode_image,
+    load_backend,
+    model_version_tag,
+)
 
 # --- Configuration ---
 load_dotenv()
 ATLAS_URI = os.getenv("ATLAS_URI")
 DB_NAME = os.getenv("DB_NAME")
 SEUIL_CONFIANCE_MIN = 0.75
+SEUIL_POIDS_VOTES = 10  # somme des poids de votes nécessaire pour valider une image
+LEASE_TTL_SECONDS = int(os.getenv("LEASE_TTL_SECONDS", "120"))
+MODEL_PATH = os.getenv("MODEL_PATH", "best.pt")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # torch | onnx | openvino
+INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "0") == "1"
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "4096"))
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", "86400"))
+IMAGE_BYTES_CACHE_SIZE = int(os.getenv("IMAGE_BYTES_CACHE_SIZE", str(256 * 1024 * 1024)))  # budget en octets
+IMAGE_VARIANTS = ("display", "original")
+IMAGE_BYTES_CACHE_MAX_ITEM = int(os.getenv("IMAGE_BYTES_CACHE_MAX_ITEM", str(4 * 1024 * 1024)))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))  # 0 = inférence dans le processus API
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, INFERENCE_WORKERS)))))
+
+# --- Pool de connexions MongoDB ---
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "20000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")  # ex. "zstd,snappy,zlib"
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # secondes
+USER_CACHE_CHANGE_STREAM = os.getenv("USER_CACHE_CHANGE_STREAM", "0") == "1"  # nécessite un replica set
+LEADERBOARD_SIZE = 5
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "10"))  # secondes
+COMPARISON_PAGE_MAX = int(os.getenv("COMPARISON_PAGE_MAX", "1000"))
+ANNOTATION_BATCH_MAX = int(os.getenv("ANNOTATION_BATCH_MAX", "200"))
+BUSY_RETRY_AFTER = int(os.getenv("BUSY_RETRY_AFTER", "5"))  # secondes, images toutes sous bail
+MONGO_TRANSACTIONS = os.getenv("MONGO_TRANSACTIONS", "0") == "1"  # nécessite un replica set
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))  # part des événements fréquents journalisés
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # protège /admin/* ; active aussi l'en-tête X-Profile
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # part des requêtes profilées
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+PROFILER = os.getenv("PROFILER", "")  # "" | cprofile | pyinstrument
+PROFILE_SLOWEST = int(os.getenv("PROFILE_SLOWEST", "10"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
 
 if not ATLAS_URI or not DB_NAME:
     raise RuntimeError("Définir ATLAS_URI et DB_NAME dans .env")
 
-# --- Connexion MongoDB ---
-client = MongoClient(ATLAS_URI, serverSelectionTimeoutMS=5000)
-try:
-    client.server_info()
-except Exception as e:
-    raise RuntimeError(f"Échec connexion MongoDB : {e}")
-
-db = client[DB_NAME]
+# --- Journalisation et métriques ---
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("classifish")
+metrics = Registry()
+request_latency = metrics.histogram(
+    "http_request_duration_seconds", ("method", "route", "status"),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    description="Durée des requêtes HTTP par route (jusqu'au début de la réponse)"
+)
+gridfs_bytes_read = metrics.counter("gridfs_bytes_read_total", description="Octets lus dans GridFS")
+
+# --- Profilage à la demande (arbre d'étapes par requête) ---
+profiler = RequestProfiler(
+    sample_rate=PROFILE_SAMPLE_RATE, admin_token=ADMIN_TOKEN, keep=PROFILE_KEEP,
+    sampler=PROFILER or None, slowest=PROFILE_SLOWEST, directory=PROFILE_DIR
+)
+
+# --- Connexion MongoDB (asynchrone) ---
+mongo_options = {
+    "maxPoolSize": MONGO_MAX_POOL_SIZE,
+    "minPoolSize": MONGO_MIN_POOL_SIZE,
+    "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+    "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+    "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+}
+if MONGO_COMPRESSORS:
+    mongo_options["compressors"] = MONGO_COMPRESSORS
+mongo_options["event_listeners"] = [MongoCommandMetrics(metrics), MongoPoolMetrics(metrics, MONGO_MAX_POOL_SIZE)]
+client = AsyncIOMotorClient(ATLAS_URI, **mongo_options)
+
+# Collections instrumentées seulement si le profilage est activé
+db = profiler.instrument(client[DB_NAME])
 images_col = db["images"]
 annotations_col = db["annotations"]
 users_col = db["users"]
 votes_col = db["votes"]
-fs = gridfs.GridFS(db)
+fs = AsyncIOMotorGridFSBucket(client[DB_NAME])
+# Index des images vues par utilisateur (remplace les listes $nin)
+progress = ProgressIndex(db)
+# Baux d'attribution : pas plus d'annotateurs simultanés que de votes encore nécessaires
+leases = LeaseManager(images_col, LEASE_TTL_SECONDS, SEUIL_POIDS_VOTES, SEUIL_CONFIANCE_MIN)
 
 # --- Nouvelle collection pour les prédictions IA ---
 ai_predictions_col = db["ai_predictions"]
+# Prédictions par image (indépendantes de l'utilisateur), une par version du modèle
+image_predictions_col = db["image_predictions"]
 
-# --- Indexes ---
-images_col.create_index("validated")
-annotations_col.create_index([("image", 1), ("user_id", 1)])
-users_col.create_index("user_id", unique=True)
-votes_col.create_index([("image_id", 1), ("user_id", 1)])
-ai_predictions_col.create_index([("image_id", 1), ("user_id", 1)])
 
 # --- Schémas Pydantic ---
 class AnnotationRequest(BaseModel):
@@ -57,6 +139,18 @@ class AnnotationRequest(BaseModel):
     is_test: bool = False
     expected_label: Optional[str] = None
 
+class BatchAnnotationItem(BaseModel):
+    image_id: str
+    label: str
+    is_test: bool = False
+    expected_label: Optional[str] = None
+    vote: bool = False
+    idempotency_key: Optional[str] = None
+
+class AnnotationBatchRequest(BaseModel):
+    user_id: str
+    items: List[BatchAnnotationItem]
+
 class VoteRequest(BaseModel):
     image_id: str
     user_id: str
@@ -75,205 +169,816 @@ class UserDetails(UserStats):
 
 # --- Chargement du modèle IA ---
 app = FastAPI()
-model = YOLO("best.pt")
-labels = ["ABL", "ALA", "ANG", "BAF", "BRE", "CHE", "HOT", "SIL"]
+if profiler.enabled:
+    # Étape « endpoint » : sépare le traitement de la sérialisation de la réponse
+    app.router.route_class = ProfiledRoute
+SPECIES_LABELS = ["ABL", "ALA", "ANG", "BAF", "BRE", "CHE", "HOT", "SIL"]
+inference_backend = None
+inference_pool = None
+if INFERENCE_WORKERS > 0:
+    # Modèle chargé dans des processus dédiés, à l'écart du GIL des requêtes
+    inference_pool = InferencePool(
+        INFERENCE_WORKERS, INFERENCE_BACKEND, MODEL_PATH, INFERENCE_INT8, INFERENCE_THREADS
+    )
+    labels = inference_pool.labels
+else:
+    inference_backend = load_backend(INFERENCE_BACKEND, MODEL_PATH, INFERENCE_INT8)
+    labels = inference_backend.labels
+if sorted(labels) != sorted(SPECIES_LABELS):
+    raise RuntimeError(f"Classes du modèle inattendues : {labels}")
+
+MODEL_VERSION = os.getenv("MODEL_VERSION") or model_version_tag(INFERENCE_BACKEND, MODEL_PATH, INFERENCE_INT8)
+
+# --- Cache des prédictions ---
+prediction_cache = LRUCache(maxsize=PREDICTION_CACHE_SIZE)
+_MISSING = object()
+
+# --- Cache des profils utilisateurs (fiabilité, compteurs), écriture traversante ---
+USER_PROFILE_PROJECTION = {
+    "_id": 0, "user_id": 1, "annotations_total": 1, "annotations_correct": 1, "accuracy": 1,
+    "test_annotations": 1, "test_correct": 1, "test_accuracy": 1
+}
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+user_cache_watcher = None
+
+
+async def get_user_profile(user_id: str):
+    """
+    Profil de l'utilisateur (sans mot de passe), lu dans le cache si possible.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await users_col.find_one({"user_id": user_id}, USER_PROFILE_PROJECTION)
+        if user:
+            user_cache.set(user_id, user)
+    return user
+
+
+def cache_user_profile(user: dict):
+    # Écriture traversante : document renvoyé par la mise à jour (ReturnDocument.AFTER)
+    if user and user.get("user_id"):
+        user_cache.set(user["user_id"], user)
+
+
+async def watch_user_changes():
+    """
+    Invalidation entre processus : chaque worker suit le change stream de la
+    collection users et rafraîchit les profils modifiés ailleurs.
+    """
+    while True:
+        try:
+            async with users_col.watch(
+                [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}],
+                full_document="updateLookup"
+            ) as stream:
+                async for change in stream:
+                    doc = change.get("fullDocument")
+                    if doc and doc.get("user_id"):
+                        user_cache.set(doc["user_id"], {k: doc.get(k) for k in USER_PROFILE_PROJECTION if k != "_id" and k in doc})
+                    else:
+                        user_cache.clear()  # Suppression : user_id inconnu, on repart de zéro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_event(logger, "user_change_stream_error", level=logging.WARNING, error=str(e))
+            user_cache.clear()
+            await asyncio.sleep(5)
+
+
+# --- Stockage hybride des images ---
+# Petits fichiers en BinData dans le document image (lus avec les métadonnées),
+# gros fichiers dans GridFS. Champs par variante : (identifiant GridFS, octets inline).
+STORAGE_FIELDS = {
+    "original": ("file_id", "data"),
+    "display": ("display_file_id", "display_data"),
+    "inference": ("inference_file_id", "inference_data"),
+}
+INLINE_EXCLUDE = {data_key: 0 for _, data_key in STORAGE_FIELDS.values()}
+
+
+def storage_projection(*variants) -> dict:
+    projection = {}
+    for variant in variants:
+        file_key, data_key = STORAGE_FIELDS[variant]
+        projection[file_key] = 1
+        projection[data_key] = 1
+    return projection
+
+
+async def read_stored_bytes(img_doc: dict, *variants) -> bytes:
+    """
+    Octets de la première variante disponible (ordre de préférence) :
+    BinData du document, sinon fichier GridFS (via le cache mémoire).
+    """
+    for variant in variants:
+        file_key, data_key = STORAGE_FIELDS[variant]
+        if img_doc.get(data_key) is not None:
+            return bytes(img_doc[data_key])
+        if img_doc.get(file_key):
+            return await read_image_bytes(img_doc[file_key])
+    raise gridfs.errors.NoFile(f"Aucun contenu pour l'image {img_doc.get('_id')}")
+
+
+# --- Cache du haut du classement (même réponse pour tous les utilisateurs) ---
+leaderboard_cache = LRUCache(maxsize=1, ttl=LEADERBOARD_TTL)
+
+# --- Cache des octets d'images (fichiers GridFS les plus demandés) ---
+image_bytes_cache = LRUCache(maxsize=None, max_bytes=IMAGE_BYTES_CACHE_SIZE)
+
+
+async def read_image_bytes(file_id) -> bytes:
+    """
+    Lit un fichier GridFS en passant par le cache mémoire borné en octets.
+    """
+    img_b = image_bytes_cache.get(file_id)
+    if img_b is None:
+        with span("gridfs.read", file_id=str(file_id)) as current:
+            grid_out = await fs.open_download_stream(file_id)
+            img_b = await grid_out.read()
+            if current:
+                current.attrs["bytes"] = len(img_b)
+        gridfs_bytes_read.inc(len(img_b))
+        if len(img_b) <= IMAGE_BYTES_CACHE_MAX_ITEM:
+            image_bytes_cache.set(file_id, img_b)
+    return img_b
+
+# --- Fonctions de prédiction ---
+def predict_batch(payloads: list):
+    """
+    Prédit l'espèce de poisson pour un lot d'images (octets encodés) en une seule
+    passe du backend configuré (PyTorch, ONNX Runtime ou OpenVINO)
+    """
+    t0 = time.perf_counter()
+    predictions = inference_backend.predict_labels([decode_image(data) for data in payloads])
+    log_event(logger, "inference_batch", LOG_SAMPLE_RATE,
+              batch_size=len(payloads), duration_ms=round((time.perf_counter() - t0) * 1000, 2))
+    return predictions
+
+
+inference_engine = InferenceEngine(
+    inference_pool.predict_batch if inference_pool else predict_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    max_inflight=max(1, INFERENCE_WORKERS)
+)
+metrics.register(inference_engine.latency_hist)
+metrics.register(inference_engine.batch_size_hist)
+metrics.register(inference_engine.queue_wait_hist)
+metrics.gauge("inference_queue_depth", inference_engine.queue_depth, "Images en attente d'inférence")
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Gabarit de la route (ex. /images/{image_id}/content) : cardinalité bornée
+        route = request.scope.get("route")
+        request_latency.observe(
+            time.perf_counter() - t0, request.method, getattr(route, "path", "unmatched"), str(status)
+        )
+
+
+async def profile_requests(request: Request, call_next):
+    # X-Profile: <ADMIN_TOKEN> force le profilage de la requête ; sinon échantillonnage
+    if not profiler.wants(request.headers.get("X-Profile")):
+        return await call_next(request)
+    return await profiler.run(request, call_next)
+
+
+if profiler.enabled:
+    app.middleware("http")(profile_requests)
+
+
+@app.on_event("startup")
+async def startup():
+    global user_cache_watcher
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        raise RuntimeError(f"Échec connexion MongoDB : {e}")
+
+    # --- Indexes ---
+    await asyncio.gather(
+        images_col.create_index("validated"),
+        annotations_col.create_index([("image", 1), ("user_id", 1)]),
+        annotations_col.create_index([("user_id", 1), ("is_test", 1)]),
+        annotations_col.create_index([("user_id", 1), ("_id", 1)]),
+        annotations_col.create_index(
+            [("user_id", 1), ("idempotency_key", 1)],
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$type": "string"}}
+        ),
+        progress.ensure_indexes(),
+        users_col.create_index("user_id", unique=True),
+        users_col.create_index([("annotations_total", -1), ("test_accuracy", -1)]),
+        votes_col.create_index([("image_id", 1), ("user_id", 1)]),
+        ai_predictions_col.create_index([("image_id", 1), ("user_id", 1)]),
+        image_predictions_col.create_index([("image_id", 1), ("model_version", 1)], unique=True),
+    )
+
+    await progress.assign_missing_ordinals()
+    await progress.assign_missing_random_keys()
+    await progress.ensure_open_count()
+    # Champ toujours présent : tri et comptage du classement par l'index
+    await users_col.update_many({"annotations_total": {"$exists": False}}, {"$set": {"annotations_total": 0}})
+
+    if USER_CACHE_CHANGE_STREAM:
+        user_cache_watcher = asyncio.create_task(watch_user_changes())
+
+
+@app.on_event("shutdown")
+def shutdown_inference():
+    if inference_pool:
+        inference_pool.shutdown()
+    if user_cache_watcher:
+        user_cache_watcher.cancel()
+
+
+async def predict_image(img_b: bytes):
+    """
+    Prédit l'espèce de poisson à partir des octets de l'image (via le micro-batching).
+    L'étape couvre l'attente du lot, le décodage et le passage du modèle.
+    """
+    with span("inference", bytes=len(img_b)):
+        return await asyncio.wrap_future(inference_engine.submit(img_b))
+
+
+async def get_prediction(image_id: str, img_doc: dict):
+    """
+    Renvoie la prédiction de l'image pour la version courante du modèle :
+    cache mémoire → collection image_predictions → inférence YOLO.
+    Les octets ne sont lus (document ou GridFS) qu'en cas d'inférence.
+    """
+    key = (image_id, MODEL_VERSION)
+    label = prediction_cache.get(key, _MISSING)
+    if label is not _MISSING:
+        return label
+
+    doc = await image_predictions_col.find_one(
+        {"image_id": image_id, "model_version": MODEL_VERSION},
+        {"predicted_label": 1}
+    )
+    if doc:
+        label = doc.get("predicted_label")
+    else:
+        if not img_doc.get("inference_file_id"):
+            # Variante d'inférence inline (ou absente) : octets relus avec le document
+            img_doc = await images_col.find_one(
+                {"_id": img_doc["_id"]}, storage_projection("inference", "original")
+            ) or img_doc
+        # Variante pré-redimensionnée à la taille d'entrée du modèle si disponible
+        img_b = await read_stored_bytes(img_doc, "inference", "original")
+        label = await predict_image(img_b)
+        await image_predictions_col.update_one(
+            {"image_id": image_id, "model_version": MODEL_VERSION},
+            {"$setOnInsert": {
+                "predicted_label": label,
+                "content_sha256": hashlib.sha256(img_b).hexdigest(),
+                "timestamp": datetime.utcnow()
+            }},
+            upsert=True
+        )
+    prediction_cache.set(key, label)
+    return label
 
-# --- Fonction de prédiction ---
-def predict_image(img_pil: Image.Image):
+# --- Sélection des images ---
+TEST_MATCH = {"ground_truth": {"$ne": None}}
+OPEN_MATCH = {"validated": False}
+NEW_MATCH = {"validated": False, "ground_truth": None}
+SAMPLE_PROJECTION = {"ground_truth": 1, "validated": 1, "file_id": 1, "inference_file_id": 1}
+
+
+class LeaseFilter:
     """
-    Prédit l'espèce de poisson à partir d'une image PIL avec YOLOv8
+    Filtre d'acceptation des candidats : les images de test sont servies librement,
+    les images à valider doivent obtenir un bail. `refused` compte les baux refusés.
     """
-    t0 = time.time()
-    results = model(img_pil, verbose=False)
-    print("Prediction time:", time.time() - t0)
-    for result in results:
-        probs = result.probs  # Probabilités des classes
-        if probs is not None:
-            class_id = probs.top1  # Meilleure classe
-            return labels[class_id]
-    return None
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.refused = 0
+
+    async def __call__(self, doc):
+        if doc.get("ground_truth"):
+            return True
+        if await leases.claim(doc["_id"], self.user_id):
+            return True
+        self.refused += 1
+        return False
 
 # --- Routes ---
 
 @app.get("/image")
-def get_image(user_id: str):
+async def get_image(user_id: str):
     max_test = 5
     test_chance = 0.1
     will_it_be_test = random.random()
     only_val = False
 
-    annotated_ids = [ann["image"] for ann in annotations_col.find({"user_id": user_id}, {"image": 1})]
-    nb_test_done = annotations_col.count_documents({"user_id": user_id, "is_test": True})
-
-    if nb_test_done < max_test:
-        pipeline = [
-            {"$match": {
-                "ground_truth": {"$ne": None},
+    # Requêtes indépendantes lancées en parallèle
+    nb_test_done, _ = await asyncio.gather(
+        annotations_col.count_documents({"user_id": user_id, "is_test": True}),
+        progress.ensure_user(user_id)
+    )
 
-                "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}
-            }},
-            {"$sample": {"size": 1}}
-        ]
-        test_img = list(images_col.aggregate(pipeline))
-        if test_img:
-            img_doc = test_img[0]
-        else:
-            pipeline = [{"$match": {"validated": False, "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}}}, {"$sample": {"size": 1}}]
-            normal_img = list(images_col.aggregate(pipeline))
-            if not normal_img:
-                raise HTTPException(404, "Aucune image disponible.")
-            img_doc = normal_img[0]
+    accept = LeaseFilter(user_id)
+    if nb_test_done < max_test or will_it_be_test <= test_chance:  # On teste
+        img_doc = await progress.sample_unseen(user_id, TEST_MATCH, SAMPLE_PROJECTION)
+        if not img_doc:
+            img_doc = await progress.sample_unseen(user_id, OPEN_MATCH, SAMPLE_PROJECTION, accept)
     else:
-        if will_it_be_test <= test_chance: # On teste
-            pipeline = [
-                {"$match": {
-                    "ground_truth": {"$ne": None},
-                    "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}
-                }},
-                {"$sample": {"size": 1}}
-            ]
-            test_img = list(images_col.aggregate(pipeline))
-            if test_img:
-                img_doc = test_img[0]
-            else:
-                pipeline = [{"$match": {"validated": False, "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}}}, {"$sample": {"size": 1}}]
-                normal_img = list(images_col.aggregate(pipeline))
-                if not normal_img:
-                    raise HTTPException(404, "Aucune image disponible.")
-                img_doc = normal_img[0]
-        else:
-            pipeline = [{"$match": {"validated": False, "ground_truth": {"$eq": None}, "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}}}, {"$sample": {"size": 1}}]
-            normal_img = list(images_col.aggregate(pipeline))
-            if not normal_img:
-                only_val = True
-                pipeline = [{"$match": {"validated": False, "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}}}, {"$sample": {"size": 1}}]
-                normal_img = list(images_col.aggregate(pipeline))
-            img_doc = normal_img[0]
-    
+        img_doc = await progress.sample_unseen(user_id, NEW_MATCH, SAMPLE_PROJECTION, accept)
+        if not img_doc:
+            only_val = True
+            img_doc = await progress.sample_unseen(user_id, OPEN_MATCH, SAMPLE_PROJECTION, accept)
+    if not img_doc and accept.refused:
+        # Images restantes toutes confiées à d'autres annotateurs : image de test en attendant
+        img_doc = await progress.sample_unseen(user_id, TEST_MATCH, SAMPLE_PROJECTION)
+        if not img_doc:
+            raise HTTPException(
+                503, "Images en cours d'annotation, réessayez.", headers={"Retry-After": str(BUSY_RETRY_AFTER)}
+            )
+        only_val = True
+    if not img_doc:
+        raise HTTPException(404, "Aucune image disponible.")
+
+    is_test = bool(img_doc.get("ground_truth")) and (nb_test_done < max_test or will_it_be_test <= test_chance or only_val)
+
+    # Prédiction IA (partagée entre utilisateurs, calculée une fois par image et par modèle)
     try:
-        grid_out = fs.get(img_doc["file_id"])
-        img_b = grid_out.read()
+        ai_prediction = await get_prediction(str(img_doc["_id"]), img_doc)
     except gridfs.errors.NoFile:
-        images_col.delete_one({"_id": img_doc["_id"]})
+        deleted = await images_col.delete_one({"_id": img_doc["_id"]})
+        if deleted.deleted_count and not img_doc.get("validated"):
+            await progress.on_image_retired(img_doc.get("ordinal"))
         raise HTTPException(500, "Fichier introuvable")
-
-    is_test = bool(img_doc.get("ground_truth")) and (nb_test_done < max_test or will_it_be_test <= test_chance or only_val)
-    encoded_image = base64.b64encode(img_b).decode("utf-8")
-
-    # Prédiction IA si c'est un test
-    ai_prediction = None
-    pil_image = Image.open(BytesIO(base64.b64decode(encoded_image)))
-    ai_prediction = predict_image(pil_image)
-    ai_predictions_col.update_one(
-        {"image_id": str(img_doc["_id"]), "user_id": user_id},
-        {"$setOnInsert": {
-            "image_id": str(img_doc["_id"]),
-            "user_id": user_id,
-            "predicted_label": ai_prediction,
-            "timestamp": datetime.utcnow()
-        }},
-        upsert=True
+    await asyncio.gather(
+        ai_predictions_col.update_one(
+            {"image_id": str(img_doc["_id"]), "user_id": user_id},
+            {"$setOnInsert": {
+                "image_id": str(img_doc["_id"]),
+                "user_id": user_id,
+                "predicted_label": ai_prediction,
+                "model_version": MODEL_VERSION,
+                "timestamp": datetime.utcnow()
+            }},
+            upsert=True
+        ),
+        progress.rerandomize(img_doc["_id"])
     )
 
     return {
         "image_id": str(img_doc["_id"]),
-        "image": encoded_image,
+        "image_url": f"/images/{img_doc['_id']}/content",
         "is_test": is_test,
         "expected_label": img_doc.get("ground_truth"),
         "ai_prediction": ai_prediction  # Non transmis à l'utilisateur
     }
 
 
-@app.post("/annotations")
-def save_annotation(ann: AnnotationRequest):
-    img_oid = ObjectId(ann.image_id)
-    img_doc = images_col.find_one({"_id": img_oid})
+def _parse_range(range_header: str, size: int):
+    """
+    Analyse un en-tête Range « bytes=début-fin » (une seule plage).
+    Renvoie (début, fin inclusive) ou None si la plage est invalide.
+    """
+    m = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:  # suffixe : les N derniers octets
+        start = max(0, size - int(m.group(2)))
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+async def _stream_grid_out(grid_out, start: int, length: int):
+    grid_out.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = await grid_out.read(min(grid_out.chunk_size, remaining))
+        if not chunk:
+            break
+        gridfs_bytes_read.inc(len(chunk))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _bytes_response(content: bytes, media_type: str, headers: dict, range_header: Optional[str]):
+    size = len(content)
+    start, end, status = 0, size - 1, 200
+    if range_header:
+        byte_range = _parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        (start, end), status = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(content[start:end + 1], status_code=status, media_type=media_type, headers=headers)
+
+
+@app.get("/images/{image_id}/content")
+async def get_image_content(
+    image_id: str,
+    variant: str = "display",
+    if_none_match: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range")
+):
+    """
+    Contenu binaire de l'image : octets inline du document (une seule requête)
+    ou fichier GridFS lu par morceaux.
+    variant = display (WebP réduit, par défaut) ou original ; repli sur l'original
+    si la variante n'a pas encore été générée.
+    Le contenu est immuable : l'identifiant GridFS (ou de l'image) sert d'ETag.
+    """
+    if variant not in IMAGE_VARIANTS:
+        raise HTTPException(400, f"Variante inconnue : {variant}")
+    if not ObjectId.is_valid(image_id):
+        raise HTTPException(404, "Image introuvable")
+    img_doc = await images_col.find_one(
+        {"_id": ObjectId(image_id)},
+        {"filename": 1, **storage_projection(variant), "file_id": 1}
+    )
     if not img_doc:
         raise HTTPException(404, "Image introuvable")
 
-    annotations_col.insert_one({
+    media_type = None
+    file_key, data_key = STORAGE_FIELDS[variant]
+    if variant == "display" and (img_doc.get(file_key) or img_doc.get(data_key) is not None):
+        media_type = "image/webp"
+    else:
+        variant = "original"
+        file_key, data_key = STORAGE_FIELDS["original"]
+        if not img_doc.get(file_key):
+            # Original inline : relu seulement quand la variante demandée manque
+            img_doc = await images_col.find_one({"_id": img_doc["_id"]}, {"filename": 1, data_key: 1}) or {}
+    media_type = media_type or mimetypes.guess_type(img_doc.get("filename") or "")[0] or "image/jpeg"
+
+    file_id = img_doc.get(file_key)
+    etag = f'"{file_id}"' if file_id else f'"{image_id}-{variant}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={IMAGE_CACHE_MAX_AGE}, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if if_none_match and {etag, "*"} & {t.strip() for t in if_none_match.split(",")}:
+        return Response(status_code=304, headers=headers)
+
+    # Petit fichier stocké dans le document : déjà lu avec les métadonnées
+    if not file_id:
+        if img_doc.get(data_key) is None:
+            raise HTTPException(404, "Fichier introuvable")
+        return _bytes_response(bytes(img_doc[data_key]), media_type, headers, range_header)
+
+    # Image chaude : servie depuis la mémoire, sans aller-retour GridFS
+    cached = image_bytes_cache.get(file_id)
+    if cached is not None:
+        return _bytes_response(cached, media_type, headers, range_header)
+
+    try:
+        grid_out = await fs.open_download_stream(file_id)
+    except gridfs.errors.NoFile:
+        raise HTTPException(404, "Fichier introuvable")
+
+    size = grid_out.length
+
+    # Petit fichier demandé en entier : lu d'un bloc et gardé en cache
+    if not range_header and size <= IMAGE_BYTES_CACHE_MAX_ITEM:
+        with span("gridfs.read", file_id=str(file_id), bytes=size):
+            img_b = await grid_out.read()
+        gridfs_bytes_read.inc(len(img_b))
+        image_bytes_cache.set(file_id, img_b)
+        return Response(img_b, media_type=media_type, headers=headers)
+
+    if range_header:
+        byte_range = _parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            _stream_grid_out(grid_out, start, end - start + 1),
+            status_code=206, media_type=media_type, headers=headers
+        )
+
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(_stream_grid_out(grid_out, 0, size), media_type=media_type, headers=headers)
+
+
+def user_annotation_update(is_test: bool, correct: bool):
+    """
+    Mise à jour (pipeline) des compteurs de l'utilisateur pour une annotation,
+    calculée côté serveur : pas de lecture préalable, pas de course entre requêtes.
+    L'annotation compte dans annotations_total si la fiabilité *avant* celle-ci
+    dépasse SEUIL_CONFIANCE_MIN.
+    """
+    return user_annotations_update([(is_test, correct)])
+
+
+def user_annotations_update(annotations):
+    """
+    Même mise à jour pour une suite d'annotations [(is_test, correct), ...],
+    appliquée dans l'ordre : les annotations hors test consécutives sont
+    regroupées, chaque test fait évoluer la fiabilité des suivantes.
+    """
+    def count_stage(n, test_correct=None):
+        fields = {"annotations_total": {"$add": [
+            {"$ifNull": ["$annotations_total", 0]},
+            {"$cond": [{"$gt": [{"$ifNull": ["$test_accuracy", 0]}, SEUIL_CONFIANCE_MIN]}, n, 0]}
+        ]}}
+        if test_correct is not None:
+            fields["test_annotations"] = {"$add": [{"$ifNull": ["$test_annotations", 0]}, 1]}
+            fields["test_correct"] = {"$add": [{"$ifNull": ["$test_correct", 0]}, 1 if test_correct else 0]}
+        return {"$set": fields}
+
+    pipeline = []
+    run = 0
+    for is_test, correct in annotations:
+        if not is_test:
+            run += 1
+            continue
+        # Les annotations en attente et ce test sont comptés avec la fiabilité courante
+        pipeline += [
+            count_stage(run + 1, correct),
+            {"$set": {"test_accuracy": {"$divide": ["$test_correct", "$test_annotations"]}}},
+        ]
+        run = 0
+    if run or not pipeline:
+        pipeline.append(count_stage(run))
+    return pipeline
+
+
+@app.post("/annotations")
+async def save_annotation(ann: AnnotationRequest):
+    img_oid = ObjectId(ann.image_id)
+    annotation = {
         "image": ann.image_id,
         "user_id": ann.user_id,
         "label": ann.label,
         "timestamp": datetime.utcnow(),
-        "is_test": getattr(ann, "is_test", False),
-        "expected_label": getattr(ann, "expected_label", None)
-    })
-
-    user = users_col.find_one({"user_id": ann.user_id})
-    if ann.is_test:
-        if not user:
-            user = {
-                "user_id": ann.user_id,
-                "test_annotations": 0,
-                "test_correct": 0,
-                "test_accuracy": 0.0,
-                "annotations_total": 0
-            }
-        total = user.get("test_annotations", 0) + 1
-        correct_count = user.get("test_correct", 0) + (1 if ann.label == ann.expected_label else 0)
-        accuracy = correct_count / total if total > 0 else 0.0
-        users_col.update_one(
-            {"user_id": ann.user_id},
-            {"$set": {
-                "test_annotations": total,
-                "test_correct": correct_count,
-                "test_accuracy": accuracy,
-            }},
-            upsert=True
+        "is_test": ann.is_test,
+        "expected_label": ann.expected_label
+    }
+    user_update = user_annotation_update(ann.is_test, ann.label == ann.expected_label)
+    image_update = {"$inc": {"annotations_count": 1}, **leases.release_update(ann.user_id)}
+
+    if MONGO_TRANSACTIONS:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                img_doc = await images_col.find_one_and_update(
+                    {"_id": img_oid}, image_update,
+                    projection={"ordinal": 1, "validated": 1}, session=session
+                )
+                if not img_doc:
+                    raise HTTPException(404, "Image introuvable")
+                await annotations_col.insert_one(annotation, session=session)
+                user = await users_col.find_one_and_update(
+                    {"user_id": ann.user_id}, user_update, upsert=True, projection=USER_PROFILE_PROJECTION,
+                    return_document=ReturnDocument.AFTER, session=session
+                )
+                await progress.mark_seen(ann.user_id, img_doc.get("ordinal"), not img_doc.get("validated"), session=session)
+        cache_user_profile(user)
+        return {"message": "Annotation enregistrée"}
+
+    # 1er aller-retour : vérifie l'image et met à jour ses compteurs en une opération
+    img_doc = await images_col.find_one_and_update(
+        {"_id": img_oid}, image_update, projection={"ordinal": 1, "validated": 1}
+    )
+    if not img_doc:
+        raise HTTPException(404, "Image introuvable")
+
+    async def update_user():
+        # Crée l'utilisateur si besoin avant mark_seen, qui ne fait que l'incrémenter
+        user = await users_col.find_one_and_update(
+            {"user_id": ann.user_id}, user_update, upsert=True, projection=USER_PROFILE_PROJECTION,
+            return_document=ReturnDocument.AFTER
         )
-    if(user.get("test_accuracy", 0) > SEUIL_CONFIANCE_MIN):
-        annotations = user.get("annotations_total", 0) + 1
-    else:
-        annotations = user.get("annotations_total", 0)
-    users_col.update_one(
-                {"user_id": ann.user_id},
-                {"$set": {
-                    "annotations_total": annotations
-                }},
-                upsert=True
-            )
-    images_col.update_one({"_id": img_oid}, {"$inc": {"annotations_count": 1}})
+        await progress.mark_seen(ann.user_id, img_doc.get("ordinal"), not img_doc.get("validated"))
+        return user
+
+    # 2e aller-retour : insertion en parallèle des mises à jour de l'utilisateur
+    _, user = await asyncio.gather(annotations_col.insert_one(annotation), update_user())
+    cache_user_profile(user)
     return {"message": "Annotation enregistrée"}
 
 
-@app.get("/ai-stats")
-def get_ai_stats(user_id: str):
-    user_tests = list(annotations_col.find({
-        "user_id": user_id,
-        "is_test": True
-    }))
-
-    if not user_tests:
-        raise HTTPException(404, "Pas d'annotations test trouvées.")
+@app.post("/annotations/batch")
+async def save_annotations_batch(batch: AnnotationBatchRequest):
+    """
+    Enregistre un lot d'annotations (et de votes) en quelques allers-retours :
+    validation des images en une requête $in, insertion par bulk_write, compteurs
+    de l'utilisateur et des images mis à jour en une fois par document.
+    Les clés d'idempotence évitent de compter deux fois un élément renvoyé.
+    Renvoie un résultat par élément, dans l'ordre du lot.
+    """
+    user_id = batch.user_id
+    items = batch.items
+    if len(items) > ANNOTATION_BATCH_MAX:
+        raise HTTPException(413, f"Lot trop volumineux (max {ANNOTATION_BATCH_MAX}).")
+
+    results = [{"index": i, "image_id": item.image_id} for i, item in enumerate(items)]
+    oids = {item.image_id: ObjectId(item.image_id) for item in items if ObjectId.is_valid(item.image_id)}
+    keys = [item.idempotency_key for item in items if item.idempotency_key]
+
+    images, already = await asyncio.gather(
+        images_col.find({"_id": {"$in": list(oids.values())}}, {"ordinal": 1, "validated": 1}).to_list(None),
+        annotations_col.distinct("idempotency_key", {"user_id": user_id, "idempotency_key": {"$in": keys}})
+    )
+    images = {str(img["_id"]): img for img in images}
+    seen_keys = set(already)
+
+    # Éléments à insérer : image existante, clé d'idempotence jamais vue
+    pending = []
+    now = datetime.utcnow()
+    for i, item in enumerate(items):
+        if item.image_id not in oids:
+            results[i]["status"] = "invalid"
+        elif item.image_id not in images:
+            results[i]["status"] = "not_found"
+        elif item.idempotency_key and item.idempotency_key in seen_keys:
+            results[i]["status"] = "duplicate"
+        else:
+            if item.idempotency_key:
+                seen_keys.add(item.idempotency_key)
+            doc = {
+                "image": item.image_id,
+                "user_id": user_id,
+                "label": item.label,
+                "timestamp": now,
+                "is_test": item.is_test,
+                "expected_label": item.expected_label
+            }
+            if item.idempotency_key:
+                doc["idempotency_key"] = item.idempotency_key
+            pending.append((i, doc))
 
-    user_correct = 0
-    ai_correct = 0
+    # Insertion non ordonnée ; une clé insérée entre-temps par un autre envoi → doublon
+    failed = {}
+    if pending:
+        try:
+            await annotations_col.bulk_write([InsertOne(doc) for _, doc in pending], ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                failed[err["index"]] = "duplicate" if err.get("code") == 11000 else "error"
+    created = []
+    for n, (i, _) in enumerate(pending):
+        results[i]["status"] = failed.get(n, "created")
+        if n not in failed:
+            created.append(items[i])
+
+    if not created:
+        return {"results": results}
+
+    # Compteurs agrégés : utilisateur (une mise à jour), images (un bulk_write), images vues
+    per_image = defaultdict(int)
+    for item in created:
+        per_image[item.image_id] += 1
+    async def update_user():
+        # Crée l'utilisateur si besoin avant mark_seen_many, qui ne fait que l'incrémenter
+        user = await users_col.find_one_and_update(
+            {"user_id": user_id},
+            user_annotations_update([(item.is_test, item.label == item.expected_label) for item in created]),
+            upsert=True,
+            projection=USER_PROFILE_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        await progress.mark_seen_many(user_id, [
+            (images[image_id].get("ordinal"), not images[image_id].get("validated"))
+            for image_id in per_image
+        ])
+        return user
+
+    user, _ = await asyncio.gather(
+        update_user(),
+        images_col.bulk_write([
+            UpdateOne({"_id": oids[image_id]}, {"$inc": {"annotations_count": n}, **leases.release_update(user_id)})
+            for image_id, n in per_image.items()
+        ], ordered=False)
+    )
+    cache_user_profile(user)
+
+    # Votes des éléments nouvellement créés, pesés par la fiabilité en fin de lot
+    voted = []
+    for i, item in enumerate(items):
+        if not item.vote or results[i]["status"] != "created":
+            continue
+        if item.label not in SPECIES_LABELS:
+            results[i]["vote"] = {"status": "invalid"}
+        elif (user or {}).get("test_accuracy", 0.0) < SEUIL_CONFIANCE_MIN:
+            results[i]["vote"] = {"status": "forbidden"}
+        else:
+            voted.append(i)
+
+    if voted:
+        reliability = user["test_accuracy"]
+        vote_weights = defaultdict(lambda: defaultdict(float))
+        for i in voted:
+            vote_weights[items[i].image_id][items[i].label] += reliability
+        image_ids = list(vote_weights)
+        vote_docs = [
+            {"image_id": items[i].image_id, "user_id": user_id, "label": items[i].label,
+             "timestamp": now, "weight": reliability}
+            for i in voted
+        ]
+        if MONGO_TRANSACTIONS:
+            # Votes et décomptes dans une transaction (une opération à la fois par session)
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await votes_col.insert_many(vote_docs, session=session)
+                    tallies = [
+                        await images_col.find_one_and_update(
+                            {"_id": oids[image_id]}, tally_update(vote_weights[image_id]),
+                            projection=TALLY_PROJECTION, return_document=ReturnDocument.AFTER,
+                            session=session
+                        )
+                        for image_id in image_ids
+                    ]
+        else:
+            # Votes insérés d'abord ; les décomptes (un $inc par image) seulement ensuite
+            await votes_col.insert_many(vote_docs, ordered=False)
+            tallies = await asyncio.gather(*(
+                images_col.find_one_and_update(
+                    {"_id": oids[image_id]},
+                    tally_update(vote_weights[image_id]),
+                    projection=TALLY_PROJECTION,
+                    return_document=ReturnDocument.AFTER
+                )
+                for image_id in image_ids
+            ))
+        outcomes = dict(zip(image_ids, await asyncio.gather(*(apply_tally(t) for t in tallies))))
+        for i in voted:
+            results[i]["vote"] = {"status": "recorded", **outcomes[items[i].image_id]}
+
+    return {"results": results}
+
+
+def ai_prediction_lookup(user_id: str):
+    """
+    Étapes joignant à chaque annotation la prédiction IA servie à l'utilisateur
+    (champ `ai_label`), via l'index (image_id, user_id) de ai_predictions.
+    """
+    return [
+        {"$lookup": {
+            "from": ai_predictions_col.name,
+            "let": {"image_id": "$image"},
+            "pipeline": [
+                {"$match": {"user_id": user_id, "$expr": {"$eq": ["$image_id", "$$image_id"]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 0, "predicted_label": 1}}
+            ],
+            "as": "ai"
+        }},
+        {"$set": {"ai_label": {"$ifNull": [{"$arrayElemAt": ["$ai.predicted_label", 0]}, None]}}},
+    ]
 
-    for test in user_tests:
-        expected = test.get("expected_label")
-        user_label = test.get("label")
-        pred = ai_predictions_col.find_one({
-            "image_id": test["image"],
-            "user_id": user_id
-        })
-        ai_label = pred.get("predicted_label") if pred else None
 
-        if user_label == expected:
-            user_correct += 1
-        if ai_label == expected:
-            ai_correct += 1
+async def compute_ai_stats(user_id: str):
+    """
+    Score de l'utilisateur et de l'IA sur les images de test (None si aucun test),
+    calculé en une seule agrégation.
+    """
+    expected = {"$ifNull": ["$expected_label", None]}
+    pipeline = [
+        {"$match": {"user_id": user_id, "is_test": True}},
+        *ai_prediction_lookup(user_id),
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "user_correct": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$label", None]}, expected]}, 1, 0]}},
+            "ai_correct": {"$sum": {"$cond": [{"$eq": ["$ai_label", expected]}, 1, 0]}},
+        }}
+    ]
+    stats = await annotations_col.aggregate(pipeline).to_list(1)
+    if not stats:
+        return None
 
-    total = len(user_tests)
+    total = stats[0]["total"]
     return {
-        "user_score": user_correct / total,
-        "ai_score": ai_correct / total,
+        "user_score": stats[0]["user_correct"] / total,
+        "ai_score": stats[0]["ai_correct"] / total,
         "total": total
     }
 
 
+@app.get("/ai-stats")
+async def get_ai_stats(user_id: str):
+    stats = await compute_ai_stats(user_id)
+    if stats is None:
+        raise HTTPException(404, "Pas d'annotations test trouvées.")
+    return stats
+
+
 @app.post("/vote_annotation")
-def vote_annotation(data: dict):
+async def vote_annotation(data: dict):
     """
     Un utilisateur vote pour une espèce → son vote est pesé par sa fiabilité.
     Si seuil atteint → validation automatique de l'image.
@@ -285,8 +990,11 @@ def vote_annotation(data: dict):
     if not image_id or not user_id or not label:
         raise HTTPException(400, "Données incomplètes.")
 
-    # Vérifie l'utilisateur
-    user = users_col.find_one({"user_id": user_id})
+    # Vérifie l'utilisateur et l'image (requêtes indépendantes)
+    user, image = await asyncio.gather(
+        get_user_profile(user_id),
+        images_col.find_one({"_id": ObjectId(image_id)}, {"_id": 1})
+    )
     if not user:
         raise HTTPException(404, "Utilisateur non trouvé.")
 
@@ -294,12 +1002,14 @@ def vote_annotation(data: dict):
     if reliability < SEUIL_CONFIANCE_MIN:  # 🚫 Seuil minimum
         raise HTTPException(403, "Fiabilité insuffisante (<75%).")
 
-    # Vérifie l'image
-    image = images_col.find_one({"_id": ObjectId(image_id)})
     if not image:
         raise HTTPException(404, "Image introuvable.")
 
-    # Enregistre le vote
+    if label not in SPECIES_LABELS:
+        raise HTTPException(400, "Espèce inconnue.")
+
+    # Enregistre le vote puis l'ajoute au décompte de l'image ($inc) : dans une
+    # transaction si possible, sinon le décompte ne bouge qu'une fois le vote inséré
     vote_doc = {
         "image_id": image_id,
         "user_id": user_id,
@@ -307,37 +1017,67 @@ def vote_annotation(data: dict):
         "timestamp": datetime.utcnow(),
         "weight": reliability
     }
-    votes_col.insert_one(vote_doc)
+    if MONGO_TRANSACTIONS:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                await votes_col.insert_one(vote_doc, session=session)
+                tally = await images_col.find_one_and_update(
+                    {"_id": ObjectId(image_id)}, tally_update({label: reliability}),
+                    projection=TALLY_PROJECTION, return_document=ReturnDocument.AFTER, session=session
+                )
+    else:
+        await votes_col.insert_one(vote_doc)
+        tally = await images_col.find_one_and_update(
+            {"_id": ObjectId(image_id)}, tally_update({label: reliability}),
+            projection=TALLY_PROJECTION, return_document=ReturnDocument.AFTER
+        )
+
+    return await apply_tally(tally)
+
+
+# Décompte des votes porté par le document image : vote_total (poids cumulé,
+# sert aussi au plafond des baux) et vote_weights.<espèce>
+TALLY_PROJECTION = {"vote_total": 1, "vote_weights": 1}
 
-    # Calcule les votes cumulés
-    votes = list(votes_col.find({"image_id": image_id}))
-    label_weights = defaultdict(float)
 
-    for v in votes:
-        label_weights[v["label"]] += v["weight"]
+def tally_update(weights: dict) -> dict:
+    inc = {f"vote_weights.{label}": w for label, w in weights.items()}
+    inc["vote_total"] = sum(weights.values())
+    return {"$inc": inc}
 
-    total_weight = sum(label_weights.values())
+
+async def apply_tally(tally: dict):
+    """
+    Évalue le décompte de l'image (tel que renvoyé par la mise à jour du vote)
+    et la valide, ou retire son étiquette, selon la certitude obtenue.
+    """
+    label_weights = (tally or {}).get("vote_weights") or {}
+    total_weight = (tally or {}).get("vote_total") or 0.0
 
     # Seuil : somme des poids ≥ 10 (ex: 15 votes * 0.8 > 10)
-    if total_weight >= 10:
+    if total_weight >= SEUIL_POIDS_VOTES and label_weights:
         best_label = max(label_weights, key=label_weights.get)
         best_score = label_weights[best_label]
         confidence = best_score / total_weight
 
         # Rafraîchissez l'étiquette si la certitude change significativement
         if confidence > 0.8:  # Seuil de certitude
-            images_col.update_one(
-                {"_id": ObjectId(image_id)},
-                {"$set": {"ground_truth": best_label, "validated": True}}
+            before = await images_col.find_one_and_update(
+                {"_id": tally["_id"]},
+                {"$set": {"ground_truth": best_label, "validated": True}},
+                projection={"ordinal": 1, "validated": 1}
             )
+            # Première validation : l'image sort des images restantes des utilisateurs
+            if before and not before.get("validated"):
+                await progress.on_image_retired(before.get("ordinal"))
             return {
                 "message": f"Image validée automatiquement : {best_label}",
                 "ground_truth": best_label,
                 "confidence_ratio": confidence
             }
         elif confidence < 0.6:  # Seuil de confiance bas
-            images_col.update_one(
-                {"_id": ObjectId(image_id)},
+            await images_col.update_one(
+                {"_id": tally["_id"]},
                 {"$unset": {"ground_truth": None}}
             )
             return {
@@ -349,11 +1089,78 @@ def vote_annotation(data: dict):
 
     return {"message": "Vote enregistré.", "total_weight": total_weight}
 
-@app.get("/user_details/{user_id}")
-def get_user_details(user_id: str):
-    user = users_col.find_one({"user_id": user_id})
+@app.get("/inference-stats")
+async def get_inference_stats():
+    """
+    Histogrammes de taille de lot et d'attente en file du moteur d'inférence.
+    """
+    return inference_engine.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Métriques au format texte Prometheus.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+async def get_cache_stats():
+    """
+    Taux de succès / d'échec des caches en mémoire du backend.
+    """
+    return {
+        "predictions": prediction_cache.stats(),
+        "image_bytes": image_bytes_cache.stats(),
+        "leaderboard": leaderboard_cache.stats(),
+        "users": user_cache.stats(),
+    }
+
+# --- Profils de requêtes (administration) ---
+def require_admin(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "Administration désactivée")
+    if not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(403, "Jeton d'administration invalide")
+
+@app.get("/admin/profiles")
+async def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """
+    Requêtes profilées récentes (plus récente d'abord), sans l'arbre d'étapes.
+    """
+    require_admin(x_admin_token)
+    return {"profiles": profiler.summaries()}
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Arbre d'étapes d'une requête (appels MongoDB, lectures GridFS, inférence, encodage).
+    """
+    require_admin(x_admin_token)
+    profile = profiler.get(profile_id)
+    if not profile:
+        raise HTTPException(404, "Profil introuvable")
+    return profile
+
+@app.get("/admin/profiles/{profile_id}/sampler")
+async def download_sampler_output(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Sortie du profileur échantillonnant (cProfile .prof ou speedscope), gardée
+    pour les PROFILE_SLOWEST requêtes les plus lentes. En mode cProfile, elle couvre
+    tout le thread de la boucle (champ sampler_scope du profil), pas la seule requête.
+    """
+    require_admin(x_admin_token)
+    profile = profiler.get(profile_id)
+    if not profile or not profile.get("sampler_output"):
+        raise HTTPException(404, "Sortie introuvable")
+    path = profiler.output_path(profile_id)
+    if not os.path.exists(path):
+        raise HTTPException(404, "Sortie introuvable (remplacée par une requête plus lente)")
+    return FileResponse(path, filename=os.path.basename(path))
+
+async def load_user_details(user_id: str):
+    user = await get_user_profile(user_id)
     if not user:
-        raise HTTPException(404, "Utilisateur non trouvé")
+        return None
     return UserDetails(
         user_id=user["user_id"],
         annotations_total=user.get("annotations_total", 0),
@@ -364,160 +1171,235 @@ def get_user_details(user_id: str):
         test_accuracy=user.get("test_accuracy", 0.0)
     )
 
+@app.get("/user_details/{user_id}")
+async def get_user_details(user_id: str):
+    details = await load_user_details(user_id)
+    if not details:
+        raise HTTPException(404, "Utilisateur non trouvé")
+    return details
+
+async def compute_remaining(user_id: str) -> int:
+    await progress.ensure_user(user_id)
+    return await progress.remaining(user_id)
+
 @app.get("/stats")
-def get_stats(user_id: str):
-    annotated_ids = [
-        ann["image"] for ann in annotations_col.find({"user_id": user_id}, {"image": 1})
-    ]
-    remaining = images_col.count_documents({
-        "validated": False,
-        "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}
-    })
+async def get_stats(user_id: str):
+    remaining = await compute_remaining(user_id)
     return {"remaining_images": remaining}
 
 @app.post("/login-or-register")
-def login_or_register(data: dict):
+async def login_or_register(data: dict):
     user_id = data.get("user_id")
     password = data.get("password")
 
     if not user_id or not password:
         raise HTTPException(400, "Nom d'utilisateur et mot de passe requis.")
 
-    user = users_col.find_one({"user_id": user_id})
+    user = await users_col.find_one({"user_id": user_id})
 
     if user:
         if user.get("password") != password:
             raise HTTPException(401, "Mot de passe incorrect.")
         return {"exists": True, "message": "Authentifié"}
     else:
-        users_col.insert_one({
+        new_user = {
             "user_id": user_id,
             "password": password,
             "test_annotations": 0,
             "test_correct": 0,
-            "test_accuracy": 1.0
-        })
+            "test_accuracy": 1.0,
+            "annotations_total": 0
+        }
+        await users_col.insert_one(new_user)
+        cache_user_profile({k: v for k, v in new_user.items() if k in USER_PROFILE_PROJECTION})
         return {"exists": False, "message": "Nouvel utilisateur créé"}
     
-@app.get("/comparison")
-def get_comparison(user_id: str):
-    # Récupère toutes les annotations de test de l'utilisateur
-    user_tests = list(annotations_col.find({
-        "user_id": user_id
-    }))
+def comparison_pipeline(user_id: str, cursor: Optional[str], limit: Optional[int]):
+    match = {"user_id": user_id}
+    if cursor:
+        match["_id"] = {"$gt": ObjectId(cursor)}
+    pipeline = [{"$match": match}, {"$sort": {"_id": 1}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return pipeline + ai_prediction_lookup(user_id) + [
+        {"$project": {
+            "image_id": "$image",
+            "attendu": {"$ifNull": ["$expected_label", None]},
+            "utilisateur": {"$ifNull": ["$label", None]},
+            "ia": "$ai_label",
+            "correct_utilisateur": {"$eq": [{"$ifNull": ["$label", None]}, {"$ifNull": ["$expected_label", None]}]},
+            "correct_ia": {"$cond": [
+                {"$and": ["$ai_label", "$expected_label"]},
+                {"$eq": ["$ai_label", "$expected_label"]},
+                None
+            ]}
+        }}
+    ]
+
 
-    if not user_tests:
+@app.get("/comparison")
+async def get_comparison(user_id: str, cursor: Optional[str] = None, limit: int = 200, format: str = "json"):
+    """
+    Annotations de l'utilisateur comparées aux prédictions de l'IA, par ordre
+    d'enregistrement. Pagination par curseur (`next_cursor` à repasser en `cursor`).
+    format=ndjson : toutes les lignes à partir du curseur, une par ligne JSON,
+    envoyées au fil de la lecture.
+    """
+    if cursor and not ObjectId.is_valid(cursor):
+        raise HTTPException(400, "Curseur invalide.")
+
+    if format == "ndjson":
+        async def stream_rows():
+            async for row in annotations_col.aggregate(comparison_pipeline(user_id, cursor, None)):
+                row["cursor"] = str(row.pop("_id"))
+                yield json.dumps(row) + "\n"
+        return StreamingResponse(stream_rows(), media_type="application/x-ndjson")
+
+    limit = max(1, min(limit, COMPARISON_PAGE_MAX))
+    rows = await annotations_col.aggregate(comparison_pipeline(user_id, cursor, limit + 1)).to_list(None)
+    if not rows and not cursor:
         raise HTTPException(404, "Aucune annotation test trouvée.")
 
-    comparisons = []
-    for test in user_tests:
-        image_id = test["image"]
-        expected = test.get("expected_label")
-        user_label = test.get("label")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = str(rows[-1]["_id"]) if has_more else None
+    for row in rows:
+        del row["_id"]
+    return {"results": rows, "next_cursor": next_cursor}
 
-        # Recherche la prédiction IA associée
-        ai_pred = ai_predictions_col.find_one({
-            "image_id": image_id,
-            "user_id": user_id
-        })
+LEADERBOARD_SORT = [("annotations_total", -1), ("test_accuracy", -1)]
 
-        ai_label = ai_pred.get("predicted_label") if ai_pred else None
 
-        comparisons.append({
-            "image_id": image_id,
-            "attendu": expected,
-            "utilisateur": user_label,
-            "ia": ai_label,
-            "correct_utilisateur": user_label == expected,
-            "correct_ia": ai_label == expected if ai_label and expected else None
-        })
+def leaderboard_entry(user: dict) -> dict:
+    return {
+        "user_id": user["user_id"],
+        "annotations_total": user.get("annotations_total") or 0,
+        "test_accuracy": round((user.get("test_accuracy") or 0.0) * 100)
+    }
 
-    return {"results": comparisons}
 
-@app.get("/leaderboard")
-def get_leaderboard(user_id: Optional[str] = None):
-    SEUIL_CONFIANCE_MIN = 0.75
+async def leaderboard_top():
+    """
+    Haut du classement, lu sur l'index (annotations_total, test_accuracy)
+    et gardé LEADERBOARD_TTL secondes en mémoire.
+    """
+    top = leaderboard_cache.get("top")
+    if top is None:
+        users = await users_col.find(
+            {}, {"_id": 0, "user_id": 1, "annotations_total": 1, "test_accuracy": 1}
+        ).sort(LEADERBOARD_SORT).limit(LEADERBOARD_SIZE).to_list(LEADERBOARD_SIZE)
+        top = [leaderboard_entry(u) for u in users]
+        leaderboard_cache.set("top", top)
+    return top
 
-    # Liste des utilisateurs fiables triés par nombre d'annotations
-    pipeline = [
-        {"$project": {
-            "user_id": 1,
-            "annotations_total": {"$ifNull": ["$annotations_total", 0]},
-            "test_accuracy": 1
-        }},
-        {"$sort": {"annotations_total": -1, "test_accuracy": -1}}
-    ]
-    all_users = list(users_col.aggregate(pipeline))
 
-    top_5 = all_users[:5]
+async def leaderboard_rank(user_id: str):
+    """
+    Rang de l'utilisateur : 1 + nombre d'utilisateurs classés devant lui
+    (comptage sur l'index, sans parcourir la liste des utilisateurs).
+    """
+    user = await get_user_profile(user_id)
+    if not user:
+        return None
+    total = user.get("annotations_total") or 0
+    accuracy = user.get("test_accuracy") or 0.0
+    ahead = await users_col.count_documents({"$or": [
+        {"annotations_total": {"$gt": total}},
+        {"annotations_total": total, "test_accuracy": {"$gt": accuracy}}
+    ]})
+    return {"rank": ahead + 1, **leaderboard_entry(user)}
+
+
+async def compute_leaderboard(user_id: Optional[str] = None):
+    # Utilisateurs triés par nombre d'annotations puis fiabilité
+    if not user_id:
+        return {"top_users": await leaderboard_top()}
+
+    top, user_rank = await asyncio.gather(leaderboard_top(), leaderboard_rank(user_id))
+    response = {"top_users": top}
+    if user_rank:
+        response["user_rank"] = user_rank
+    return response
 
-    response = {
-        "top_users": [
-            {
-                "user_id": u["user_id"],
-                "annotations_total": u["annotations_total"],
-                "test_accuracy": round(u.get("test_accuracy", 0.0) * 100)
-            }
-            for u in top_5
-        ]
+@app.get("/leaderboard")
+async def get_leaderboard(user_id: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    """
+    Classement, avec ETag : un client dont la copie est à jour reçoit un 304.
+    """
+    data = await compute_leaderboard(user_id)
+    etag = '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16] + '"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(LEADERBOARD_TTL)}"}
+    if if_none_match and {etag, "*"} & {t.strip() for t in if_none_match.split(",")}:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(data, headers=headers)
+
+@app.get("/dashboard")
+async def get_dashboard(user_id: str):
+    """
+    Toutes les données de la barre latérale en une requête (requêtes Mongo concurrentes).
+    """
+    leaderboard, ai_stats, remaining, details = await asyncio.gather(
+        compute_leaderboard(user_id),
+        compute_ai_stats(user_id),
+        compute_remaining(user_id),
+        load_user_details(user_id)
+    )
+    return {
+        "leaderboard": leaderboard,
+        "ai_stats": ai_stats,
+        "remaining_images": remaining,
+        "user_details": details
     }
 
-    # Si un user_id est fourni, trouver sa position
-    if user_id:
-        for rank, user in enumerate(all_users, start=1):
-            if user["user_id"] == user_id:
-                response["user_rank"] = {
-                    "rank": rank,
-                    "user_id": user_id,
-                    "annotations_total": user["annotations_total"],
-                    "test_accuracy": round(user.get("test_accuracy", 0.0) * 100)
-                }
-                break
-
-    return response
-
 @app.post("/report_unrecognizable")
-def report_unrecognizable(data: dict):
+async def report_unrecognizable(data: dict):
     image_id = data.get("image_id")
     user_id = data.get("user_id")
     
     if not image_id or not user_id:
         raise HTTPException(400, "Données incomplètes.")
 
-    user = users_col.find_one({"user_id": user_id})
+    user = await get_user_profile(user_id)
     if not user or user.get("test_accuracy", 0.0) < SEUIL_CONFIANCE_MIN:
         raise HTTPException(403, "Fiabilité insuffisante pour signaler une image.")
 
-    image = images_col.find_one({"_id": ObjectId(image_id)})
-    if not image:
-        raise HTTPException(404, "Image introuvable.")
-
-    # Ajoute le user_id au champ "reported_by"
-    update = images_col.update_one(
+    # Ajoute le user_id au champ "reported_by" et récupère le document à jour
+    updated_image = await images_col.find_one_and_update(
         {"_id": ObjectId(image_id)},
-        {"$addToSet": {"reported_by": user_id}}
+        {"$addToSet": {"reported_by": user_id}, **leases.release_update(user_id)},
+        projection=INLINE_EXCLUDE,
+        return_document=ReturnDocument.AFTER
     )
-
-    updated_image = images_col.find_one({"_id": ObjectId(image_id)})
+    if not updated_image:
+        raise HTTPException(404, "Image introuvable.")
     reporters = updated_image.get("reported_by", [])
 
     # Enregistre annotation spéciale (pour filtrer dans les prochaines images)
-    annotations_col.insert_one({
-        "image": image_id,
-        "user_id": user_id,
-        "label": "UNRECOGNIZABLE",
-        "timestamp": datetime.utcnow(),
-        "is_test": False,
-        "expected_label": None
-    })
+    await asyncio.gather(
+        annotations_col.insert_one({
+            "image": image_id,
+            "user_id": user_id,
+            "label": "UNRECOGNIZABLE",
+            "timestamp": datetime.utcnow(),
+            "is_test": False,
+            "expected_label": None
+        }),
+        progress.mark_seen(user_id, updated_image.get("ordinal"), not updated_image.get("validated"))
+    )
 
     if len(reporters) >= 3:
         # Supprimer image de GridFS + DB
-        try:
-            fs.delete(updated_image["file_id"])
-        except Exception:
-            pass  # Si le fichier n'existe plus, on ignore
-        images_col.delete_one({"_id": ObjectId(image_id)})
+        for key, _ in STORAGE_FIELDS.values():
+            if not updated_image.get(key):
+                continue
+            image_bytes_cache.pop(updated_image[key])
+            try:
+                await fs.delete(updated_image[key])
+            except Exception:
+                pass  # Si le fichier n'existe plus, on ignore
+        deleted = await images_col.delete_one({"_id": ObjectId(image_id)})
+        if deleted.deleted_count and not updated_image.get("validated"):
+            await progress.on_image_retired(updated_image.get("ordinal"))
         return {"message": "Image supprimée après 3 signalements."}
 
     return {"message": f"Signalement enregistré ({len(reporters)}/3)"}
@@ -0,0 +1,277 @@
+# metrics.py
+
+import bisect
+import json
+import logging
+import random
+import threading
+
+from pymongo import monitoring
+
+
+class Histogram:
+    """
+    Histogramme cumulatif à seaux fixes (style Prometheus).
+    """
+
+    def __init__(self, name: str, buckets, description: str = ""):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # dernier seau = +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative, acc = {}, 0
+        for bound, c in zip(self.buckets + (float("inf"),), counts):
+            acc += c
+            cumulative["+Inf" if bound == float("inf") else str(bound)] = acc
+        return {"buckets": cumulative, "sum": total, "count": count}
+
+    def expose(self, labels: str = ""):
+        snap = self.snapshot()
+        sep = "," if labels else ""
+        lines = [
+            f'{self.name}_bucket{{{labels}{sep}le="{le}"}} {count}'
+            for le, count in snap["buckets"].items()
+        ]
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{self.name}_sum{suffix} {snap['sum']}")
+        lines.append(f"{self.name}_count{suffix} {snap['count']}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+class LabeledHistogram:
+    """
+    Famille d'histogrammes indexée par des valeurs d'étiquettes (route, collection...).
+    """
+
+    def __init__(self, name: str, labelnames, buckets, description: str = ""):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values) -> Histogram:
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.name, self.buckets, self.description))
+        return child
+
+    def observe(self, value: float, *labels):
+        self.labels(*labels).observe(value)
+
+    def expose(self):
+        lines = []
+        for values, child in sorted(self._children.items()):
+            lines += child.expose(_format_labels(self.labelnames, values))
+        return lines
+
+
+class Counter:
+    """
+    Compteur monotone, avec étiquettes optionnelles.
+    """
+
+    def __init__(self, name: str, labelnames=(), description: str = ""):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        return [
+            f"{self.name}{{{_format_labels(self.labelnames, labels)}}} {v}" if labels else f"{self.name} {v}"
+            for labels, v in values
+        ]
+
+
+class Gauge:
+    """
+    Jauge lue au moment de l'export (fonction sans argument) : aucun coût sur le chemin des requêtes.
+    """
+
+    def __init__(self, name: str, read, description: str = ""):
+        self.name = name
+        self.description = description
+        self._read = read
+
+    def expose(self):
+        return [f"{self.name} {self._read()}"]
+
+
+class Registry:
+    """
+    Ensemble des métriques exportées au format texte Prometheus.
+    """
+
+    TYPES = {Histogram: "histogram", LabeledHistogram: "histogram", Counter: "counter", Gauge: "gauge"}
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, labelnames, buckets, description=""):
+        return self.register(LabeledHistogram(name, labelnames, buckets, description))
+
+    def counter(self, name, labelnames=(), description=""):
+        return self.register(Counter(name, labelnames, description))
+
+    def gauge(self, name, read, description=""):
+        return self.register(Gauge(name, read, description))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            if metric.description:
+                lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {self.TYPES[type(metric)]}")
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+# --- Instrumentation MongoDB (PyMongo / Motor) ---
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Durée des commandes MongoDB par collection et opération. La durée vient de
+    l'événement du pilote (duration_micros) : rien n'est chronométré ici.
+    """
+
+    def __init__(self, registry: Registry):
+        self.duration = registry.histogram(
+            "mongo_command_duration_seconds", ("collection", "command"),
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+            description="Durée des commandes MongoDB"
+        )
+        self.failures = registry.counter(
+            "mongo_command_failures_total", ("collection", "command"),
+            description="Commandes MongoDB en échec"
+        )
+        self._collections = {}
+
+    def started(self, event):
+        # getMore porte l'identifiant du curseur, la collection est dans un champ à part
+        key = "collection" if event.command_name == "getMore" else event.command_name
+        collection = event.command.get(key)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        self.duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        self.duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        self.failures.inc(1, collection, event.command_name)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Occupation du pool de connexions : connexions ouvertes, empruntées, en attente.
+    """
+
+    def __init__(self, registry: Registry, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self.checkout_failures = registry.counter(
+            "mongo_pool_checkout_failures_total", description="Emprunts de connexion en échec (délai, pool fermé)"
+        )
+        registry.gauge("mongo_pool_connections", lambda: self.open, "Connexions ouvertes")
+        registry.gauge("mongo_pool_checked_out", lambda: self.checked_out, "Connexions empruntées")
+        registry.gauge("mongo_pool_wait_queue", lambda: self.waiting, "Emprunts en attente d'une connexion")
+        registry.gauge(
+            "mongo_pool_utilization", lambda: self.checked_out / max(1, self.max_pool_size),
+            "Part du pool (maxPoolSize, par serveur) empruntée"
+        )
+
+    def _add(self, **deltas):
+        # Événements émis depuis les threads du pilote
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1)
+        self.checkout_failures.inc()
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+# --- Journalisation structurée échantillonnée ---
+def log_event(logger: logging.Logger, event: str, sample_rate: float = 1.0, level: int = logging.INFO, **fields):
+    """
+    Écrit un événement sous forme d'une ligne JSON, pour une fraction `sample_rate`
+    des appels (les événements fréquents ne saturent pas les journaux).
+    """
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"event": event, **fields}, default=str))
@@ -0,0 +1,314 @@
+# profiling.py
+
+import heapq
+import hmac
+import inspect
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from fastapi.routing import APIRoute
+
+_current_span = ContextVar("profiling_span", default=None)
+
+
+class Span:
+    """
+    Étape chronométrée d'une requête profilée ; les sous-étapes forment un arbre.
+    """
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float = None) -> dict:
+        origin = self.start if origin is None else origin
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            **({"attrs": self.attrs} if self.attrs else {}),
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Ouvre une étape sous l'étape courante. Sans requête profilée en cours, ne fait rien.
+    Les tâches lancées par asyncio.gather héritent de l'étape courante.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    current = Span(name, **attrs)
+    parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.finish()
+        _current_span.reset(token)
+
+
+async def _traced(awaitable, name: str):
+    with span(name):
+        return await awaitable
+
+
+# --- Instrumentation des collections Motor ---
+class _ProfiledCursor:
+    def __init__(self, cursor, name: str):
+        self._cursor = cursor
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._cursor, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if result is self._cursor:  # sort(), limit()... : on garde le proxy
+                return self
+            if inspect.isawaitable(result):
+                return _traced(result, f"{self._name}.{attr}")
+            return result
+        return call
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+
+class ProfiledCollection:
+    """
+    Enveloppe d'une collection Motor : chaque appel attendu (find_one, to_list,
+    bulk_write...) devient une étape de la requête profilée en cours.
+    Le pilote exécute les commandes dans ses threads, hors du contexte de la
+    requête : l'instrumentation se fait donc ici, côté appelant.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._prefix = f"mongo.{collection.name}"
+
+    def __getattr__(self, attr):
+        value = getattr(self._collection, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if _current_span.get() is None:
+                return result
+            if inspect.isawaitable(result):
+                return _traced(result, f"{self._prefix}.{attr}")
+            if hasattr(result, "to_list"):
+                return _ProfiledCursor(result, f"{self._prefix}.{attr}")
+            return result
+        return call
+
+
+class ProfiledDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        return ProfiledCollection(self._db[name])
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
+
+
+# --- Étape « endpoint » : sépare le traitement de l'encodage de la réponse ---
+class ProfiledRoute(APIRoute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        call = self.dependant.call
+        if inspect.iscoroutinefunction(call):
+            async def endpoint(*a, **kw):
+                with span("endpoint"):
+                    return await call(*a, **kw)
+            self.dependant.call = endpoint
+
+
+# --- Profileur échantillonnant (optionnel) ---
+class _Sampler:
+    """
+    cProfile (sortie .prof, pour flameprof / snakeviz) ou pyinstrument
+    (sortie speedscope). Un seul à la fois : ces profileurs sont globaux.
+    cProfile observe tout le thread de la boucle d'événements : sa sortie
+    contient aussi les requêtes traitées en même temps. pyinstrument (async_mode)
+    n'attribue que le temps de la requête profilée.
+    """
+
+    EXTENSIONS = {"cprofile": "prof", "pyinstrument": "speedscope.json"}
+    SCOPES = {
+        "cprofile": "thread de la boucle d'événements (inclut les requêtes concurrentes)",
+        "pyinstrument": "requête profilée uniquement",
+    }
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.extension = self.EXTENSIONS[mode]
+        self.scope = self.SCOPES[mode]
+        self._busy = threading.Lock()
+
+    def start(self):
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            if self.mode == "cprofile":
+                import cProfile
+
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                from pyinstrument import Profiler
+
+                profiler = Profiler(async_mode="enabled")
+                profiler.start()
+            return profiler
+        except Exception:
+            self._busy.release()
+            raise
+
+    def stop(self, profiler):
+        try:
+            if self.mode == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+        finally:
+            self._busy.release()
+
+    def write(self, profiler, path: str):
+        if self.mode == "cprofile":
+            profiler.dump_stats(path)
+        else:
+            from pyinstrument.renderers import SpeedscopeRenderer
+
+            with open(path, "w") as f:
+                f.write(profiler.output(SpeedscopeRenderer()))
+
+
+class RequestProfiler:
+    """
+    Profilage à la demande des requêtes : en-tête X-Profile (valeur = jeton
+    d'administration) ou échantillonnage aléatoire. Les arbres d'étapes des
+    `keep` dernières requêtes profilées sont gardés en mémoire ; en mode
+    échantillonnant, la sortie brute des `slowest` plus lentes est écrite sur disque.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, admin_token: str = None, keep: int = 200,
+                 sampler: str = None, slowest: int = 10, directory: str = "profiles"):
+        self.sample_rate = sample_rate
+        self.admin_token = admin_token
+        self.keep = keep
+        self.slowest = slowest
+        self.directory = directory
+        self.sampler = _Sampler(sampler) if sampler else None
+        self._profiles = OrderedDict()
+        self._slowest = []  # tas (durée, id) des sorties brutes conservées
+        self._lock = threading.Lock()
+        if self.sampler:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or bool(self.admin_token)
+
+    def wants(self, header: str = None) -> bool:
+        if self.admin_token and header and hmac.compare_digest(header, self.admin_token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def instrument(self, db):
+        return ProfiledDatabase(db) if self.enabled else db
+
+    async def run(self, request, call_next):
+        root = Span("request", method=request.method, path=request.url.path)
+        token = _current_span.set(root)
+        sampled = self.sampler.start() if self.sampler else None
+        try:
+            response = await call_next(request)
+        finally:
+            root.finish()
+            _current_span.reset(token)
+            if sampled is not None:
+                self.sampler.stop(sampled)
+
+        # Temps entre la fin du traitement et la réponse prête (validation, encodage JSON)
+        endpoint = next((c for c in reversed(root.children) if c.name == "endpoint"), None)
+        if endpoint and endpoint.end is not None:
+            encode = Span("response_encode")
+            encode.start, encode.end = endpoint.end, root.end
+            root.children.append(encode)
+
+        route = request.scope.get("route")
+        root.attrs.update(route=getattr(route, "path", None), status=response.status_code)
+        profile_id = self._store(root, sampled)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    def _store(self, root: Span, sampled) -> str:
+        profile_id = uuid.uuid4().hex[:16]
+        entry = {
+            "id": profile_id,
+            "timestamp": datetime.utcnow().isoformat(),
+            "duration_ms": round(root.duration * 1000, 3),
+            "route": root.attrs.get("route"),
+            "status": root.attrs.get("status"),
+            "tree": root.to_dict(),
+            "sampler_output": None,
+        }
+        evicted_file = None
+        keep_output = False
+        with self._lock:
+            self._profiles[profile_id] = entry
+            while len(self._profiles) > self.keep:
+                self._profiles.popitem(last=False)
+            if sampled is not None:
+                if len(self._slowest) < self.slowest:
+                    heapq.heappush(self._slowest, (root.duration, profile_id))
+                    keep_output = True
+                elif root.duration > self._slowest[0][0]:
+                    _, evicted = heapq.heapreplace(self._slowest, (root.duration, profile_id))
+                    evicted_file = self.output_path(evicted)
+                    keep_output = True
+        if keep_output:
+            self.sampler.write(sampled, self.output_path(profile_id))
+            entry["sampler_output"] = os.path.basename(self.output_path(profile_id))
+            entry["sampler_scope"] = self.sampler.scope
+        if evicted_file and os.path.exists(evicted_file):
+            os.remove(evicted_file)
+        return profile_id
+
+    def output_path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.{self.sampler.extension}")
+
+    def summaries(self):
+        with self._lock:
+            entries = list(self._profiles.values())
+        return [{k: v for k, v in e.items() if k != "tree"} for e in reversed(entries)]
+
+    def get(self, profile_id: str):
+        return self._profiles.get(profile_id)
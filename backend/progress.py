@@ -0,0 +1,367 @@
+# progress.py
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+
+from bson import ObjectId
+from bson.int64 import Int64
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+WORD_BITS = 64
+ORDINAL_COUNTER = "image_ordinal"
+OPEN_COUNTER = "open_images"  # images non validées, maintenu à l'import et au retrait
+
+
+def _to_int64(bits: int) -> Int64:
+    # Mot de 64 bits non signé → entier signé stocké par MongoDB
+    return Int64(bits - (1 << 64) if bits >= 1 << 63 else bits)
+
+
+def _from_int64(value) -> int:
+    return int(value or 0) & ((1 << 64) - 1)
+
+
+class ProgressIndex:
+    """
+    Index des images déjà vues par chaque utilisateur.
+
+    Chaque image reçoit un ordinal entier ; les images vues par un utilisateur
+    forment un bitmap découpé en mots de 64 bits (collection user_seen, un document
+    par mot non vide), mis à jour atomiquement avec $bit. Le nombre d'images
+    restantes se déduit de deux compteurs maintenus : images non validées
+    (collection counters) et `seen_pending` sur l'utilisateur.
+    Aucune liste d'identifiants n'est chargée ni envoyée au serveur.
+
+    Le tirage s'appuie sur une clé aléatoire indexée `rand` (dans [0, 1)),
+    retirée à chaque fois que l'image est servie.
+    """
+
+    def __init__(self, db, candidates: int = 32, tries: int = 4, max_refusals: int = 8,
+                 scan_pages: int = 4, scan_page_size: int = 256):
+        self.images_col = db["images"]
+        self.users_col = db["users"]
+        self.annotations_col = db["annotations"]
+        self.seen_col = db["user_seen"]
+        self.counters_col = db["counters"]
+        self.candidates = candidates
+        self.tries = tries
+        self.max_refusals = max_refusals
+        self.scan_pages = scan_pages
+        self.scan_page_size = scan_page_size
+        self._ready_users = set()
+
+    async def ensure_indexes(self):
+        await asyncio.gather(
+            self.images_col.create_index("ordinal", unique=True, sparse=True),
+            self.images_col.create_index([("validated", 1), ("ground_truth", 1), ("rand", 1)]),
+            self.images_col.create_index([("ground_truth", 1), ("rand", 1)]),
+            self.images_col.create_index([("validated", 1), ("ground_truth", 1), ("ordinal", 1)]),
+            self.seen_col.create_index([("user_id", 1), ("w", 1)], unique=True),
+            self.seen_col.create_index("w"),
+        )
+
+    # --- Ordinaux des images ---
+    async def reserve_ordinals(self, n: int) -> int:
+        """
+        Réserve n ordinaux consécutifs et renvoie le premier.
+        """
+        counter = await self.counters_col.find_one_and_update(
+            {"_id": ORDINAL_COUNTER},
+            {"$inc": {"seq": n}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - n
+
+    async def assign_missing_ordinals(self):
+        missing = await self.images_col.find({"ordinal": {"$exists": False}}, {"_id": 1}).to_list(None)
+        if not missing:
+            return 0
+        first = await self.reserve_ordinals(len(missing))
+        await self.images_col.bulk_write([
+            UpdateOne({"_id": img["_id"], "ordinal": {"$exists": False}}, {"$set": {"ordinal": first + i}})
+            for i, img in enumerate(missing)
+        ], ordered=False)
+        return len(missing)
+
+    # --- Compteur global des images non validées ---
+    async def ensure_open_count(self):
+        """
+        Initialise le compteur s'il n'existe pas encore (un seul comptage complet).
+        """
+        if await self.counters_col.find_one({"_id": OPEN_COUNTER}, {"_id": 1}):
+            return
+        n = await self.images_col.count_documents({"validated": False})
+        try:
+            await self.counters_col.insert_one({"_id": OPEN_COUNTER, "n": n})
+        except DuplicateKeyError:
+            pass  # initialisé entre-temps par une autre instance
+
+    async def recount_open(self) -> int:
+        """
+        Recalcule le compteur (réparation hors ligne, voir _rebuild_all).
+        """
+        n = await self.images_col.count_documents({"validated": False})
+        await self.counters_col.update_one({"_id": OPEN_COUNTER}, {"$set": {"n": n}}, upsert=True)
+        return n
+
+    # --- Clé aléatoire indexée ---
+    async def assign_missing_random_keys(self):
+        result = await self.images_col.update_many(
+            {"rand": {"$exists": False}},
+            [{"$set": {"rand": {"$rand": {}}}}]
+        )
+        return result.modified_count
+
+    async def rerandomize(self, image_oid):
+        """
+        Nouvelle clé aléatoire pour une image servie : elle ne reste pas
+        « derrière » le même point de départ pour les tirages suivants.
+        """
+        await self.images_col.update_one({"_id": image_oid}, {"$set": {"rand": random.random()}})
+
+    # --- Bitmap des images vues ---
+    async def mark_seen(self, user_id: str, ordinal: int, pending: bool, session=None) -> bool:
+        """
+        Marque l'image comme vue. Renvoie True si elle ne l'était pas encore.
+        pending : l'image compte encore dans les images restantes (non validée).
+        session : session Motor optionnelle (écriture dans une transaction).
+        Le document utilisateur n'est jamais créé ici (pas d'upsert) : la route
+        d'annotation le crée, avant cet appel.
+        """
+        if ordinal is None:
+            return False
+        w, bit = divmod(ordinal, WORD_BITS)
+        before = await self.seen_col.find_one_and_update(
+            {"user_id": user_id, "w": w},
+            {"$bit": {"bits": {"or": _to_int64(1 << bit)}}},
+            upsert=True,
+            projection={"bits": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        newly_seen = not before or not (_from_int64(before.get("bits")) >> bit) & 1
+        if newly_seen and pending:
+            await self.users_col.update_one(
+                {"user_id": user_id}, {"$inc": {"seen_pending": 1}}, session=session
+            )
+        return newly_seen
+
+    async def mark_seen_many(self, user_id: str, images) -> int:
+        """
+        Version groupée de mark_seen : images = [(ordinal, pending), ...].
+        Une mise à jour par mot de bitmap concerné (et non par image), puis un
+        seul $inc du compteur. Renvoie le nombre d'images nouvellement vues.
+        """
+        masks, pending_masks = {}, {}
+        for ordinal, pending in images:
+            if ordinal is None:
+                continue
+            w, bit = divmod(ordinal, WORD_BITS)
+            masks[w] = masks.get(w, 0) | (1 << bit)
+            if pending:
+                pending_masks[w] = pending_masks.get(w, 0) | (1 << bit)
+        if not masks:
+            return 0
+
+        words = list(masks)
+        befores = await asyncio.gather(*(
+            self.seen_col.find_one_and_update(
+                {"user_id": user_id, "w": w},
+                {"$bit": {"bits": {"or": _to_int64(masks[w])}}},
+                upsert=True,
+                projection={"bits": 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            for w in words
+        ))
+        newly_seen = newly_pending = 0
+        for w, before in zip(words, befores):
+            new_bits = masks[w] & ~_from_int64((before or {}).get("bits"))
+            newly_seen += bin(new_bits).count("1")
+            newly_pending += bin(new_bits & pending_masks.get(w, 0)).count("1")
+        if newly_pending:
+            await self.users_col.update_one(
+                {"user_id": user_id}, {"$inc": {"seen_pending": newly_pending}}
+            )
+        return newly_seen
+
+    async def on_image_retired(self, ordinal: int):
+        """
+        L'image ne fait plus partie des images restantes (validée ou supprimée) :
+        elle sort du compteur de tous les utilisateurs qui l'avaient vue.
+        """
+        await self.counters_col.update_one({"_id": OPEN_COUNTER}, {"$inc": {"n": -1}})
+        if ordinal is None:
+            return
+        w, bit = divmod(ordinal, WORD_BITS)
+        users = await self.seen_col.distinct("user_id", {"w": w, "bits": {"$bitsAllSet": [bit]}})
+        if users:
+            await self.users_col.update_many(
+                {"user_id": {"$in": users}}, {"$inc": {"seen_pending": -1}}
+            )
+
+    async def _seen_words(self, user_id: str, words):
+        docs = await self.seen_col.find(
+            {"user_id": user_id, "w": {"$in": list(words)}}, {"w": 1, "bits": 1}
+        ).to_list(None)
+        return {d["w"]: _from_int64(d.get("bits")) for d in docs}
+
+    async def _filter_unseen(self, user_id: str, docs):
+        words = await self._seen_words(user_id, {d["ordinal"] // WORD_BITS for d in docs})
+        return [
+            d for d in docs
+            if not (words.get(d["ordinal"] // WORD_BITS, 0) >> (d["ordinal"] % WORD_BITS)) & 1
+        ]
+
+    async def _pick(self, unseen, accept, budget: int):
+        """
+        Premier candidat accepté, et nombre de refus (au plus `budget`).
+        """
+        random.shuffle(unseen)
+        refused = 0
+        for doc in unseen:
+            if accept is None or await accept(doc):
+                return doc, refused
+            refused += 1
+            if refused >= budget:
+                break
+        return None, refused
+
+    async def sample_unseen(self, user_id: str, match: dict, projection: dict = None, accept=None):
+        """
+        Tire une image non vue correspondant à `match` : on se place sur une clé
+        aléatoire, on lit les images suivantes via l'index (O(log n)) et on écarte
+        celles déjà vues grâce aux seuls mots de bitmap concernés.
+        accept : coroutine optionnelle qui peut refuser un candidat (ex. bail indisponible).
+        Au plus `max_refusals` refus par tirage : des images non vues existent mais sont
+        indisponibles, on renvoie None sans parcourir toute la plage.
+        Si le tirage aléatoire échoue, parcours ordonné borné (voir _scan_unseen).
+        """
+        projection = {**(projection or {}), "ordinal": 1}
+        refused = 0
+
+        for _ in range(self.tries):
+            start = random.random()
+            docs = await self.images_col.find(
+                {**match, "rand": {"$gte": start}}, projection
+            ).sort("rand", 1).limit(self.candidates).to_list(self.candidates)
+            if len(docs) < self.candidates:  # Bouclage en début de plage
+                docs += await self.images_col.find(
+                    {**match, "rand": {"$lt": start}}, projection
+                ).sort("rand", 1).limit(self.candidates - len(docs)).to_list(None)
+            if not docs:
+                return None
+            doc, n = await self._pick(await self._filter_unseen(user_id, docs), accept, self.max_refusals - refused)
+            if doc:
+                return doc
+            refused += n
+            if refused >= self.max_refusals:
+                return None
+        if refused:
+            return None
+
+        return await self._scan_unseen(user_id, match, projection, accept)
+
+    async def _scan_unseen(self, user_id: str, match: dict, projection: dict, accept):
+        """
+        Utilisateur ayant presque tout vu : parcours par ordinal, au plus `scan_pages`
+        pages par appel. Il reprend au curseur de l'utilisateur pour ce filtre
+        (scan_from.<clé>, tous les ordinaux ≤ curseur sont déjà vus), que chaque page
+        entièrement vue fait avancer : le parcours complet est réparti entre les appels.
+        """
+        key = hashlib.sha1(json.dumps(match, sort_keys=True, default=str).encode()).hexdigest()[:12]
+        user = await self.users_col.find_one({"user_id": user_id}, {f"scan_from.{key}": 1})
+        start = last = ((user or {}).get("scan_from") or {}).get(key, -1)
+        doc = None
+        for _ in range(self.scan_pages):
+            docs = await self.images_col.find(
+                {**match, "ordinal": {"$gt": last}}, projection
+            ).sort("ordinal", 1).limit(self.scan_page_size).to_list(self.scan_page_size)
+            if not docs:
+                break
+            unseen = await self._filter_unseen(user_id, docs)
+            if unseen:
+                doc, _ = await self._pick(unseen, accept, self.max_refusals)
+                break
+            last = docs[-1]["ordinal"]
+        if last > start:
+            await self.users_col.update_one({"user_id": user_id}, {"$max": {f"scan_from.{key}": last}})
+        return doc
+
+    async def remaining(self, user_id: str) -> int:
+        counter, user = await asyncio.gather(
+            self.counters_col.find_one({"_id": OPEN_COUNTER}, {"n": 1}),
+            self.users_col.find_one({"user_id": user_id}, {"seen_pending": 1})
+        )
+        return max(0, (counter or {}).get("n", 0) - ((user or {}).get("seen_pending") or 0))
+
+    # --- Migration depuis les annotations existantes ---
+    async def ensure_user(self, user_id: str):
+        """
+        Construit l'index d'un utilisateur à partir de ses annotations (une seule fois).
+        Un identifiant inconnu n'a aucune progression : rien n'est créé (les routes
+        de lecture ne doivent pas réserver un nom avant l'inscription).
+        """
+        if user_id in self._ready_users:
+            return
+        user = await self.users_col.find_one({"user_id": user_id}, {"progress_ready": 1})
+        if not user:
+            return
+        if not user.get("progress_ready"):
+            await self.rebuild_user(user_id)
+        self._ready_users.add(user_id)
+
+    async def rebuild_user(self, user_id: str):
+        image_ids = await self.annotations_col.distinct("image", {"user_id": user_id})
+        oids = [ObjectId(i) for i in image_ids if ObjectId.is_valid(i)]
+        images = await self.images_col.find(
+            {"_id": {"$in": oids}, "ordinal": {"$exists": True}},
+            {"ordinal": 1, "validated": 1}
+        ).to_list(None)
+
+        masks = {}
+        for img in images:
+            w, bit = divmod(img["ordinal"], WORD_BITS)
+            masks[w] = masks.get(w, 0) | (1 << bit)
+        if masks:
+            await self.seen_col.bulk_write([
+                UpdateOne({"user_id": user_id, "w": w}, {"$bit": {"bits": {"or": _to_int64(m)}}}, upsert=True)
+                for w, m in masks.items()
+            ], ordered=False)
+
+        pending = sum(1 for img in images if not img.get("validated"))
+        await self.users_col.update_one(
+            {"user_id": user_id},
+            {"$set": {"seen_pending": pending, "progress_ready": True}}
+        )
+
+
+async def _rebuild_all(db):
+    progress = ProgressIndex(db)
+    await progress.ensure_indexes()
+    assigned = await progress.assign_missing_ordinals()
+    print(f"Ordinaux attribués : {assigned}")
+    keyed = await progress.assign_missing_random_keys()
+    print(f"Clés aléatoires attribuées : {keyed}")
+    print(f"Images non validées : {await progress.recount_open()}")
+    user_ids = await db["annotations"].distinct("user_id")
+    for user_id in user_ids:
+        await progress.rebuild_user(user_id)
+        print(f"Index reconstruit pour {user_id}")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Reconstruit l'index des images vues par utilisateur")
+    parser.parse_args()
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("ATLAS_URI"))
+    asyncio.run(_rebuild_all(client[os.getenv("DB_NAME")]))
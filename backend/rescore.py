@@ -0,0 +1,244 @@
+# rescore.py
+#
+# Calcule hors ligne les prédictions de toutes les images (ou de celles qui
+# n'en ont pas pour la version courante du modèle) et les enregistre dans
+# image_predictions, avec les k étiquettes les plus probables.
+#
+#   python rescore.py --workers 4 --batch-size 64 --top-k 3
+#   python rescore.py --all --reset        # recalcule tout depuis le début
+#   python rescore.py --purge-stale        # supprime les prédictions des autres versions
+#
+# Les prédictions sont indexées par version du modèle : l'API ne lit que la
+# sienne et ne supprime jamais celles des autres (déploiement progressif,
+# backends différents, précalcul du modèle suivant). La purge est explicite.
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+import gridfs
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from inference import InferencePool, decode_image, load_backend, model_version_tag
+
+
+def iter_chunks(cursor, size: int):
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Checkpoint:
+    """
+    Dernier _id d'image traité pour une version du modèle : permet de reprendre
+    le job là où il s'est arrêté.
+    """
+
+    def __init__(self, path: str, model_version: str, reset: bool = False):
+        self.path = path
+        self.model_version = model_version
+        self.last_id = None
+        if not reset and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("model_version") == model_version and state.get("last_id"):
+                self.last_id = ObjectId(state["last_id"])
+
+    def save(self, last_id):
+        self.last_id = last_id
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"model_version": self.model_version, "last_id": str(last_id)}, f)
+        os.replace(tmp, self.path)
+
+
+class Rescorer:
+    def __init__(self, db, args, model_version: str):
+        self.images_col = db["images"]
+        self.predictions_col = db["image_predictions"]
+        self.fs = gridfs.GridFS(db)
+        self.args = args
+        self.model_version = model_version
+        self.decoders = ThreadPoolExecutor(max_workers=args.decode_threads)
+        if args.workers > 0:
+            self.pool = InferencePool(args.workers, args.backend, args.model, args.int8, args.threads_per_worker)
+            self.backend = None
+        else:
+            self.pool = None
+            self.backend = load_backend(args.backend, args.model, args.int8)
+
+    def _load(self, doc):
+        """
+        Lit (variante d'inférence si elle existe) et décode une image. Exécuté dans un thread.
+        Les petits contenus sont inline dans le document (BinData), les autres dans GridFS.
+        """
+        try:
+            if doc.get("inference_data") is not None:
+                data = bytes(doc["inference_data"])
+            elif doc.get("inference_file_id"):
+                data = self.fs.get(doc["inference_file_id"]).read()
+            elif doc.get("data") is not None:
+                data = bytes(doc["data"])
+            else:
+                data = self.fs.get(doc["file_id"]).read()
+        except (gridfs.errors.NoFile, KeyError):
+            return None
+        return decode_image(data), hashlib.sha256(data).hexdigest()
+
+    def _pending_docs(self, chunk):
+        if self.args.all:
+            return self._with_originals(chunk)
+        ids = [str(doc["_id"]) for doc in chunk]
+        done = set(self.predictions_col.distinct(
+            "image_id", {"image_id": {"$in": ids}, "model_version": self.model_version}
+        ))
+        return self._with_originals([doc for doc in chunk if str(doc["_id"]) not in done])
+
+    def _with_originals(self, docs):
+        """
+        Le parcours ne lit que la variante d'inférence : l'original (souvent inline,
+        donc volumineux) n'est chargé que pour les images qui n'en ont pas.
+        """
+        missing = [doc["_id"] for doc in docs if doc.get("inference_data") is None and not doc.get("inference_file_id")]
+        if missing:
+            originals = {
+                doc["_id"]: doc
+                for doc in self.images_col.find({"_id": {"$in": missing}}, {"file_id": 1, "data": 1})
+            }
+            for doc in docs:
+                doc.update(originals.get(doc["_id"], {}))
+        return docs
+
+    def _submit(self, docs):
+        loaded = list(self.decoders.map(self._load, docs))
+        docs = [doc for doc, item in zip(docs, loaded) if item is not None]
+        loaded = [item for item in loaded if item is not None]
+        images = [img for img, _ in loaded]
+        if not images:
+            return docs, [], None
+        if self.pool:
+            return docs, loaded, self.pool.predict_top_k(images, self.args.top_k)
+        return docs, loaded, self.backend.predict_top_k(images, self.args.top_k)
+
+    def _write(self, docs, loaded, top_k):
+        now = datetime.utcnow()
+        ops = [
+            UpdateOne(
+                {"image_id": str(doc["_id"]), "model_version": self.model_version},
+                {"$set": {
+                    "predicted_label": preds[0][0] if preds else None,
+                    "top_k": [{"label": label, "prob": prob} for label, prob in preds],
+                    "content_sha256": sha,
+                    "timestamp": now
+                }},
+                upsert=True
+            )
+            for doc, (_, sha), preds in zip(docs, loaded, top_k)
+        ]
+        if ops:
+            self.predictions_col.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    def run(self, checkpoint: Checkpoint):
+        query = {"_id": {"$gt": checkpoint.last_id}} if checkpoint.last_id else {}
+        cursor = self.images_col.find(
+            query, {"inference_file_id": 1, "inference_data": 1}
+        ).sort("_id", 1)
+        if self.args.limit:
+            cursor = cursor.limit(self.args.limit)
+
+        inflight = deque()
+        max_inflight = max(2, 2 * self.args.workers)
+        scanned = written = 0
+        t0 = last_report = time.perf_counter()
+
+        def drain_one():
+            nonlocal written
+            last_id, docs, loaded, result = inflight.popleft()
+            top_k = result.result() if isinstance(result, Future) else (result or [])
+            written += self._write(docs, loaded, top_k)
+            # Lots terminés dans l'ordre : tout ce qui précède last_id est enregistré
+            checkpoint.save(last_id)
+
+        for chunk in iter_chunks(cursor, self.args.batch_size):
+            scanned += len(chunk)
+            inflight.append((chunk[-1]["_id"], *self._submit(self._pending_docs(chunk))))
+            while len(inflight) >= max_inflight:
+                drain_one()
+
+            now = time.perf_counter()
+            if now - last_report >= self.args.report_every:
+                elapsed = now - t0
+                print(f"{scanned} images parcourues, {written} prédictions écrites "
+                      f"({written / elapsed:.1f} images/s)")
+                last_report = now
+
+        while inflight:
+            drain_one()
+
+        elapsed = time.perf_counter() - t0
+        print(f"✅ Terminé : {scanned} images parcourues, {written} prédictions écrites en {elapsed:.1f} s "
+              f"({written / elapsed if elapsed else 0:.1f} images/s)")
+
+    def close(self):
+        self.decoders.shutdown()
+        if self.pool:
+            self.pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcul hors ligne des prédictions IA des images")
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", "best.pt"))
+    parser.add_argument("--backend", default=os.getenv("INFERENCE_BACKEND", "torch"))
+    parser.add_argument("--int8", action="store_true", default=os.getenv("INFERENCE_INT8", "0") == "1")
+    parser.add_argument("--all", action="store_true", help="Recalcule aussi les images déjà prédites")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Processus d'inférence (0 = dans ce processus)")
+    parser.add_argument("--threads-per-worker", type=int, default=2)
+    parser.add_argument("--decode-threads", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--checkpoint", default="rescore_checkpoint.json")
+    parser.add_argument("--reset", action="store_true", help="Ignore le point de reprise existant")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Secondes entre deux bilans")
+    parser.add_argument("--purge-stale", action="store_true",
+                        help="Supprime les prédictions des autres versions du modèle, puis quitte")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = MongoClient(os.getenv("ATLAS_URI"))[os.getenv("DB_NAME")]
+    model_version = os.getenv("MODEL_VERSION") or model_version_tag(args.backend, args.model, args.int8)
+    print(f"Version du modèle : {model_version}")
+
+    if args.purge_stale:
+        # À lancer une fois toutes les instances de l'API passées à cette version
+        result = db["image_predictions"].delete_many({"model_version": {"$ne": model_version}})
+        print(f"{result.deleted_count} prédiction(s) d'autres versions supprimée(s)")
+        return
+
+    checkpoint = Checkpoint(args.checkpoint, model_version, args.reset)
+    if checkpoint.last_id:
+        print(f"Reprise après l'image {checkpoint.last_id}")
+
+    rescorer = Rescorer(db, args, model_version)
+    try:
+        rescorer.run(checkpoint)
+    finally:
+        rescorer.close()
+
+
+if __name__ == "__main__":
+    main()
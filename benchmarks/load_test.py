@@ -0,0 +1,363 @@
+# benchmarks/load_test.py
+#
+# Test de charge de bout en bout de l'API : ensemence une base MongoDB locale
+# (images synthétiques inline ou dans GridFS, utilisateurs, annotations, votes)
+# puis rejoue des sessions d'annotation concurrentes directement sur l'application
+# ASGI de backend/main.py (httpx, sans serveur HTTP). Débit et p50/p95/p99 par route.
+#
+#   python benchmarks/load_test.py --uri mongodb://localhost:27017 --images 20000 --users 200 \
+#       --concurrency 32 --duration 60 --output bench_load.json
+#   python benchmarks/load_test.py ... --baseline bench_load.json   # écarts avec un run précédent
+#
+# Le modèle (MODEL_PATH, INFERENCE_BACKEND...) est chargé comme en production :
+# l'inférence fait partie de la mesure pour les images sans prédiction enregistrée.
+# Dépendance supplémentaire : httpx (voir backend/requirements-optional.txt).
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from io import BytesIO
+
+import httpx
+from bson import ObjectId
+from bson.binary import Binary
+from PIL import Image, ImageDraw
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+LABELS = ["ABL", "ALA", "ANG", "BAF", "BRE", "CHE", "HOT", "SIL"]
+PASSWORD = "bench"
+
+
+# --- Données synthétiques ---
+def synthetic_images(count: int, width: int, height: int):
+    """
+    Quelques JPEG aléatoires (fond + ellipses) réutilisés par toutes les images.
+    """
+    payloads = []
+    for _ in range(count):
+        img = Image.new("RGB", (width, height), tuple(random.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = random.randrange(width), random.randrange(height)
+            w, h = random.randrange(20, width // 2), random.randrange(10, height // 3)
+            draw.ellipse((x, y, x + w, y + h), fill=tuple(random.randrange(256) for _ in range(3)))
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        payloads.append(buf.getvalue())
+    return payloads
+
+
+async def seed(main, args):
+    """
+    Remplit la base de test. Les ordinaux et clés aléatoires sont attribués
+    ensuite par le démarrage de l'application.
+    """
+    db = main.client[main.DB_NAME]
+    await main.client.drop_database(main.DB_NAME)
+    payloads = synthetic_images(args.distinct_images, args.image_width, args.image_height)
+
+    image_ids = []
+    batch, uploads = [], []
+    for i in range(args.images):
+        payload = random.choice(payloads)
+        doc = {
+            "_id": ObjectId(),
+            "filename": f"bench_{i}.jpg",
+            "ground_truth": random.choice(LABELS) if random.random() < args.test_ratio else None,
+            "validated": False,
+            "annotations_count": 0,
+        }
+        if random.random() < args.gridfs_ratio:
+            uploads.append(main.fs.upload_from_stream(doc["filename"], payload))
+        else:
+            doc["data"] = Binary(payload)
+        batch.append(doc)
+        image_ids.append(doc["_id"])
+        if len(batch) == 1000:
+            await _insert_images(db, batch, uploads)
+            batch, uploads = [], []
+    if batch:
+        await _insert_images(db, batch, uploads)
+
+    users = [f"bench_user_{i}" for i in range(args.users)]
+    accuracy = {u: random.uniform(0.4, 1.0) for u in users}
+    annotations, votes = [], []
+    tallies = defaultdict(lambda: defaultdict(float))
+    counts = defaultdict(lambda: {"annotations_total": 0, "test_annotations": 0, "test_correct": 0})
+    for user_id in users:
+        for image_id in random.sample(image_ids, min(args.annotations_per_user, len(image_ids))):
+            label = random.choice(LABELS)
+            is_test = random.random() < args.test_ratio
+            correct = is_test and random.random() < accuracy[user_id]
+            annotations.append({
+                "image": str(image_id), "user_id": user_id, "label": label,
+                "timestamp": datetime.utcnow(), "is_test": is_test,
+                "expected_label": label if correct else None,
+            })
+            counts[user_id]["annotations_total"] += 1
+            counts[user_id]["test_annotations"] += is_test
+            counts[user_id]["test_correct"] += correct
+            if random.random() < args.vote_ratio:
+                votes.append({
+                    "image_id": str(image_id), "user_id": user_id, "label": label,
+                    "weight": accuracy[user_id], "timestamp": datetime.utcnow(),
+                })
+                tallies[image_id][label] += accuracy[user_id]
+
+    await db["users"].insert_many([{
+        "user_id": u,
+        "password": PASSWORD,
+        **counts[u],
+        "test_accuracy": accuracy[u],
+    } for u in users])
+    for i in range(0, len(annotations), 10000):
+        await db["annotations"].insert_many(annotations[i:i + 10000], ordered=False)
+    for i in range(0, len(votes), 10000):
+        await db["votes"].insert_many(votes[i:i + 10000], ordered=False)
+    for image_id, weights in tallies.items():
+        await db["images"].update_one(
+            {"_id": image_id},
+            {"$set": {"vote_weights": dict(weights), "vote_total": sum(weights.values())}}
+        )
+
+    # Démarrage de l'API : index, ordinaux, clés de tirage
+    await main.startup()
+
+    predicted = random.sample(image_ids, int(len(image_ids) * args.predicted_ratio))
+    for i in range(0, len(predicted), 10000):
+        await db["image_predictions"].insert_many([{
+            "image_id": str(image_id), "model_version": main.MODEL_VERSION,
+            "predicted_label": random.choice(LABELS), "timestamp": datetime.utcnow(),
+        } for image_id in predicted[i:i + 10000]], ordered=False)
+    for user_id in users:
+        await main.progress.rebuild_user(user_id)
+
+    print(f"Ensemencé : {len(image_ids)} images, {len(users)} utilisateurs, "
+          f"{len(annotations)} annotations, {len(votes)} votes, {len(predicted)} prédictions")
+    return users
+
+
+async def _insert_images(db, batch, uploads):
+    file_ids = iter(await asyncio.gather(*uploads))
+    for doc in batch:
+        if "data" not in doc:
+            doc["file_id"] = next(file_ids)
+    await db["images"].insert_many(batch, ordered=False)
+
+
+# --- Génération de charge ---
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def call(self, client, name: str, method: str, url: str, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except Exception:
+            response, status = None, "exception"
+        self.timings[name].append((time.perf_counter() - t0) * 1000)
+        self.statuses[name][str(status)] += 1
+        return response
+
+
+async def session(client, recorder: Recorder, user_id: str, args):
+    """
+    Une session du frontend : connexion, barre latérale, puis une suite
+    d'images (affichage, annotation, vote éventuel, rafraîchissement de la barre latérale).
+    En mode « batch » (par défaut, comme le frontend), annotation et vote partent
+    dans un seul POST /annotations/batch avec une clé d'idempotence ; le mode
+    « single » rejoue l'ancien enchaînement /annotations puis /vote_annotation.
+    """
+    await recorder.call(client, "POST /login-or-register", "POST", "/login-or-register",
+                        json={"user_id": user_id, "password": PASSWORD})
+    await recorder.call(client, "GET /dashboard", "GET", "/dashboard", params={"user_id": user_id})
+
+    for n in range(args.images_per_session):
+        response = await recorder.call(client, "GET /image", "GET", "/image", params={"user_id": user_id})
+        if response is None or response.status_code != 200:
+            break
+        image = response.json()
+        await recorder.call(client, "GET /images/{image_id}/content", "GET", image["image_url"])
+
+        label = random.choice(LABELS)
+        if image["is_test"] and random.random() < 0.7:
+            label = image["expected_label"]
+        vote = not image["is_test"] and random.random() < args.vote_ratio
+        item = {
+            "image_id": image["image_id"], "label": label,
+            "is_test": image["is_test"], "expected_label": image["expected_label"],
+        }
+        if args.write_mode == "batch":
+            await recorder.call(client, "POST /annotations/batch", "POST", "/annotations/batch", json={
+                "user_id": user_id,
+                "items": [{**item, "vote": vote, "idempotency_key": uuid.uuid4().hex}],
+            })
+        else:
+            await recorder.call(client, "POST /annotations", "POST", "/annotations",
+                                json={**item, "user_id": user_id})
+            if vote:
+                await recorder.call(client, "POST /vote_annotation", "POST", "/vote_annotation",
+                                    json={"image_id": image["image_id"], "user_id": user_id, "label": label})
+        if (n + 1) % args.sidebar_every == 0:
+            await recorder.call(client, "GET /dashboard", "GET", "/dashboard", params={"user_id": user_id})
+            await recorder.call(client, "GET /leaderboard", "GET", "/leaderboard", params={"user_id": user_id})
+
+
+async def virtual_user(client, recorder: Recorder, users, deadline: float, args):
+    while time.perf_counter() < deadline:
+        # Une part des sessions vient de nouveaux comptes (inscription)
+        if random.random() < args.new_user_ratio:
+            user_id = f"bench_new_{ObjectId()}"
+        else:
+            user_id = random.choice(users)
+        await session(client, recorder, user_id, args)
+
+
+def percentile(sorted_values, q: float) -> float:
+    # Rang le plus proche
+    idx = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+def summarize(recorder: Recorder, elapsed: float):
+    endpoints = {}
+    for name, timings in sorted(recorder.timings.items()):
+        timings = sorted(timings)
+        statuses = dict(recorder.statuses[name])
+        endpoints[name] = {
+            "requests": len(timings),
+            "throughput_rps": len(timings) / elapsed,
+            "statuses": statuses,
+            "errors": sum(c for s, c in statuses.items() if s == "exception" or s.startswith("5")),
+            "mean_ms": statistics.mean(timings),
+            "p50_ms": percentile(timings, 0.50),
+            "p95_ms": percentile(timings, 0.95),
+            "p99_ms": percentile(timings, 0.99),
+            "max_ms": timings[-1],
+        }
+    total = sum(e["requests"] for e in endpoints.values())
+    return {"requests": total, "throughput_rps": total / elapsed, "endpoints": endpoints}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(summary, baseline=None):
+    base = (baseline or {}).get("summary", {}).get("endpoints", {})
+    print(f"\n{'route':<34} {'req':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for name, e in summary["endpoints"].items():
+        line = (f"{name:<34} {e['requests']:>7} {e['throughput_rps']:>8.1f} {e['p50_ms']:>8.1f}"
+                f" {e['p95_ms']:>8.1f} {e['p99_ms']:>8.1f} {e['errors']:>5}")
+        if name in base and base[name]["p95_ms"]:
+            line += f"   p95 {100 * (e['p95_ms'] / base[name]['p95_ms'] - 1):+.0f} %"
+        print(line)
+    print(f"\nTotal : {summary['requests']} requêtes, {summary['throughput_rps']:.1f} req/s")
+
+
+async def run(args, main):
+    users = await seed(main, args) if not args.skip_seed else []
+    if args.skip_seed:
+        await main.startup()
+        users = await main.users_col.distinct("user_id", {"user_id": {"$regex": "^bench_user_"}})
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        if args.warmup:
+            print(f"Échauffement ({args.warmup:.0f} s)...")
+            deadline = time.perf_counter() + args.warmup
+            await asyncio.gather(*(virtual_user(client, Recorder(), users, deadline, args)
+                                   for _ in range(args.concurrency)))
+
+        print(f"Charge : {args.concurrency} utilisateurs simultanés pendant {args.duration:.0f} s...")
+        recorder = Recorder()
+        t0 = time.perf_counter()
+        deadline = t0 + args.duration
+        await asyncio.gather(*(virtual_user(client, recorder, users, deadline, args)
+                               for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    summary = summarize(recorder, elapsed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+
+    main.shutdown_inference()
+    if not args.keep:
+        await main.client.drop_database(main.DB_NAME)
+
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "uri")}
+        report = {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "elapsed_s": elapsed,
+            "params": params,
+            "summary": summary,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRésultats enregistrés dans {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge de bout en bout de l'API")
+    parser.add_argument("--uri", default=os.getenv("BENCH_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="classifish_bench_load")
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--annotations-per-user", type=int, default=50)
+    parser.add_argument("--vote-ratio", type=float, default=0.3, help="Part des annotations suivies d'un vote")
+    parser.add_argument("--test-ratio", type=float, default=0.05, help="Part d'images de test")
+    parser.add_argument("--gridfs-ratio", type=float, default=0.3, help="Part d'images stockées dans GridFS")
+    parser.add_argument("--predicted-ratio", type=float, default=0.5,
+                        help="Part d'images dont la prédiction est déjà enregistrée")
+    parser.add_argument("--distinct-images", type=int, default=32, help="Images synthétiques différentes")
+    parser.add_argument("--image-width", type=int, default=640)
+    parser.add_argument("--image-height", type=int, default=480)
+    parser.add_argument("--concurrency", type=int, default=32, help="Utilisateurs simultanés")
+    parser.add_argument("--duration", type=float, default=60.0, help="Durée de la mesure (s)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Échauffement non mesuré (s)")
+    parser.add_argument("--images-per-session", type=int, default=20)
+    parser.add_argument("--write-mode", choices=["batch", "single"], default="batch",
+                        help="batch : POST /annotations/batch (comme le frontend) ; "
+                             "single : POST /annotations puis /vote_annotation")
+    parser.add_argument("--sidebar-every", type=int, default=5, help="Rafraîchit la barre latérale toutes les N images")
+    parser.add_argument("--new-user-ratio", type=float, default=0.05, help="Part des sessions avec inscription")
+    parser.add_argument("--skip-seed", action="store_true", help="Réutilise une base déjà ensemencée (avec --keep)")
+    parser.add_argument("--keep", action="store_true", help="Conserve la base à la fin")
+    parser.add_argument("--baseline", help="Résultats JSON d'un run précédent à comparer")
+    parser.add_argument("--output", help="Fichier JSON de résultats")
+    args = parser.parse_args()
+
+    # La configuration de l'API est lue à l'import de main.py
+    os.environ["ATLAS_URI"] = args.uri
+    os.environ["DB_NAME"] = args.db
+    import main as api  # noqa: E402
+
+    asyncio.run(run(args, api))
+
+
+if __name__ == "__main__":
+    main()
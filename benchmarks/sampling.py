@@ -0,0 +1,137 @@
+# benchmarks/sampling.py
+#
+# Compare le tirage d'image historique ($match + $nin + $sample) au tirage
+# par clé aléatoire indexée du backend, sur 10k / 100k / 1M images.
+#
+#   python benchmarks/sampling.py --uri mongodb://localhost:27017 --sizes 10000 100000 1000000
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from progress import ProgressIndex  # noqa: E402
+
+LABELS = ["ABL", "ALA", "ANG", "BAF", "BRE", "CHE", "HOT", "SIL"]
+USER_ID = "bench_user"
+
+
+async def seed(db, n_images: int, n_annotated: int, test_ratio: float):
+    await db.drop_collection("images")
+    await db.drop_collection("annotations")
+    await db.drop_collection("users")
+    await db.drop_collection("user_seen")
+
+    batch = []
+    for i in range(n_images):
+        batch.append({
+            "_id": ObjectId(),
+            "ground_truth": random.choice(LABELS) if random.random() < test_ratio else None,
+            "validated": False,
+            "ordinal": i,
+            "rand": random.random(),
+        })
+        if len(batch) == 10000:
+            await db["images"].insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await db["images"].insert_many(batch, ordered=False)
+
+    annotated = await db["images"].aggregate([{"$sample": {"size": n_annotated}}, {"$project": {"_id": 1}}]).to_list(None)
+    if annotated:
+        await db["annotations"].insert_many([
+            {"image": str(a["_id"]), "user_id": USER_ID, "label": "ABL", "is_test": False}
+            for a in annotated
+        ])
+
+    progress = ProgressIndex(db)
+    await progress.ensure_indexes()
+    await db["images"].create_index("validated")
+    await db["annotations"].create_index([("image", 1), ("user_id", 1)])
+    await progress.rebuild_user(USER_ID)
+    return progress
+
+
+async def legacy_sample(db, match: dict):
+    # Reproduit l'ancien get_image : liste complète des annotations + $nin + $sample
+    annotated_ids = [a["image"] async for a in db["annotations"].find({"user_id": USER_ID}, {"image": 1})]
+    pipeline = [
+        {"$match": {**match, "_id": {"$nin": [ObjectId(i) for i in annotated_ids]}}},
+        {"$sample": {"size": 1}}
+    ]
+    docs = await db["images"].aggregate(pipeline).to_list(1)
+    return docs[0] if docs else None
+
+
+async def indexed_sample(progress, match: dict):
+    doc = await progress.sample_unseen(USER_ID, match, {"ground_truth": 1})
+    if doc:
+        await progress.rerandomize(doc["_id"])
+    return doc
+
+
+async def measure(fn, iterations: int):
+    timings = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        await fn()
+        timings.append((time.perf_counter() - t0) * 1000)
+    timings.sort()
+    return {
+        "mean_ms": statistics.mean(timings),
+        "p50_ms": timings[len(timings) // 2],
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "max_ms": timings[-1],
+    }
+
+
+async def run(args):
+    client = AsyncIOMotorClient(args.uri)
+    db = client[args.db]
+    matches = {
+        "test": {"ground_truth": {"$ne": None}},
+        "new": {"validated": False, "ground_truth": None},
+    }
+    report = []
+    for size in args.sizes:
+        print(f"\n=== {size} images (ensemencement...) ===")
+        progress = await seed(db, size, min(args.annotated, size // 2), args.test_ratio)
+        for name, match in matches.items():
+            legacy = await measure(lambda: legacy_sample(db, match), args.iterations)
+            indexed = await measure(lambda: indexed_sample(progress, match), args.iterations)
+            row = {"images": size, "branch": name, "legacy": legacy, "indexed": indexed,
+                   "speedup_p50": legacy["p50_ms"] / indexed["p50_ms"] if indexed["p50_ms"] else None}
+            report.append(row)
+            print(f"{name:>5} | $sample p50 {legacy['p50_ms']:8.2f} ms p95 {legacy['p95_ms']:8.2f} ms"
+                  f" | indexé p50 {indexed['p50_ms']:7.2f} ms p95 {indexed['p95_ms']:7.2f} ms"
+                  f" | x{row['speedup_p50']:.1f}")
+
+    await client.drop_database(args.db)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRésultats enregistrés dans {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du tirage aléatoire d'images")
+    parser.add_argument("--uri", default=os.getenv("BENCH_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="classifish_bench_sampling")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--annotated", type=int, default=5000, help="Annotations de l'utilisateur simulé")
+    parser.add_argument("--test-ratio", type=float, default=0.05, help="Part d'images de test")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", help="Fichier JSON de résultats")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
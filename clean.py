@@ -16,7 +16,7 @@ if not db_name:
 db = client[db_name]
 
 # Suppression des collections standard
-collections = ["images", "annotations", "users", "ai_predictions", "votes"]
+collections = ["images", "annotations", "users", "ai_predictions", "votes", "image_predictions", "user_seen", "counters"]
 for col in collections:
     if col in db.list_collection_names():
         db.drop_collection(col)
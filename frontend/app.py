@@ -6,16 +6,226 @@ import types
 sys.modules["torch.classes"] = types.ModuleType("torch.classes")
 import torch._classes
 
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import requests
-from io import BytesIO
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-import base64
 
 # --- Configuration ---
 load_dotenv()
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+PREFETCH_SIZE = int(os.getenv("PREFETCH_SIZE", "3"))  # images préparées à l'avance par session
+PREFETCH_IDLE_TIMEOUT = float(os.getenv("PREFETCH_IDLE_TIMEOUT", "600"))  # secondes sans clic avant arrêt
+POST_RETRIES = 3
+COMPARISON_CHUNK = 200  # lignes de comparaison reçues entre deux rafraîchissements du tableau
+DASHBOARD_TTL = int(os.getenv("DASHBOARD_TTL", "30"))  # secondes, données de la barre latérale
+
+
+# --- Session HTTP partagée (connexions réutilisées) ---
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    # 503 : images toutes sous bail, l'attente (Retry-After) est gérée par le préchargeur
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# --- Données de la barre latérale (une seule requête, mise en cache) ---
+@st.cache_data(ttl=DASHBOARD_TTL, show_spinner=False)
+def fetch_dashboard(user_id, version):
+    """
+    `version` change quand une annotation de l'utilisateur aboutit : le cache
+    n'est invalidé que lorsque ses propres chiffres ont pu évoluer.
+    """
+    res = get_http_session().get(f"{BACKEND_URL}/dashboard", params={"user_id": user_id}, timeout=10)
+    res.raise_for_status()
+    return res.json()
+
+
+class ImagesBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Images en cours d'annotation par d'autres participants, nouvel essai dans un instant.")
+        self.retry_after = retry_after
+
+
+class ImagePrefetcher:
+    """
+    File des prochaines images d'un utilisateur, remplie par un thread de fond :
+    un clic affiche immédiatement l'image suivante sans attendre le backend.
+    Streamlit ne signale pas la fin d'une session : le thread s'arrête de lui-même
+    après PREFETCH_IDLE_TIMEOUT sans demande d'image, ou à la déconnexion (stop).
+    """
+
+    def __init__(self, user_id, size=PREFETCH_SIZE):
+        self.user_id = user_id
+        self.size = size
+        self.http = get_http_session()
+        self._items = deque()
+        self._known_ids = set()  # images déjà en file ou affichées
+        self._cond = threading.Condition()
+        self.exhausted = False
+        self.error = None
+        self.stopped = False
+        self._last_used = time.monotonic()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _fetch_one(self):
+        res = self.http.get(f"{BACKEND_URL}/image", params={"user_id": self.user_id}, timeout=30)
+        if res.status_code == 404:
+            return None
+        if res.status_code == 503:
+            raise ImagesBusy(float(res.headers.get("Retry-After", "5")))
+        res.raise_for_status()
+        data = res.json()
+        # Octets bruts servis par le backend (mis en cache HTTP, pas de base64)
+        img_res = self.http.get(f"{BACKEND_URL}{data['image_url']}", timeout=30)
+        img_res.raise_for_status()
+        data["content"] = img_res.content
+        return data
+
+    def _idle(self):
+        return time.monotonic() - self._last_used > PREFETCH_IDLE_TIMEOUT
+
+    def _pause(self, seconds):
+        with self._cond:
+            self._cond.wait_for(lambda: self.stopped, timeout=seconds)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.stopped and not self._idle() and (len(self._items) >= self.size or self.exhausted):
+                    self._cond.wait(timeout=PREFETCH_IDLE_TIMEOUT)
+                # Aucune demande d'image depuis longtemps (onglet fermé) : on s'arrête
+                if self.stopped or self._idle():
+                    self.stopped = True
+                    self._items.clear()
+                    break
+            try:
+                data = self._fetch_one()
+            except ImagesBusy as e:
+                self.error = str(e)
+                self._pause(e.retry_after)
+                continue
+            except Exception as e:
+                self.error = str(e)
+                self._pause(1)
+                continue
+            with self._cond:
+                if self.stopped:
+                    break
+                self.error = None
+                if data is None:
+                    self.exhausted = not self._items
+                    if self.exhausted:
+                        self._cond.notify_all()
+                    else:
+                        self._cond.wait(timeout=2)  # les annotations en cours libèrent peut-être des images
+                    continue
+                if data["image_id"] not in self._known_ids:
+                    self._known_ids.add(data["image_id"])
+                    self._items.append(data)
+                    self._cond.notify_all()
+
+    def stop(self):
+        """
+        Arrête le remplissage (déconnexion, changement d'utilisateur) ; aucun
+        refill possible ensuite, il faut créer un nouveau préchargeur.
+        """
+        with self._cond:
+            # Les images restées en file ne seront pas affichées : leurs baux expireront
+            self.stopped = True
+            self._items.clear()
+            self._cond.notify_all()
+
+    def next(self, timeout=30):
+        """
+        Image suivante (attend la première si la file est vide), ou None si plus aucune.
+        """
+        with self._cond:
+            self._last_used = time.monotonic()
+            self._cond.wait_for(lambda: self._items or self.exhausted or self.stopped, timeout=timeout)
+            item = self._items.popleft() if self._items else None
+            self._cond.notify_all()
+            return item
+
+    def refill(self):
+        # Relance le remplissage après un 404 (ex. nouvelles images disponibles)
+        with self._cond:
+            if self.stopped:
+                return
+            self.exhausted = False
+            self._cond.notify_all()
+
+
+class AnnotationSender:
+    """
+    Envoi des annotations et votes en arrière-plan, avec nouvelles tentatives.
+    Chaque clic porte une clé d'idempotence (via /annotations/batch) : une
+    tentative répétée après une réponse perdue n'est pas comptée deux fois.
+    Les résultats sont récupérés au rerun suivant pour être affichés.
+    """
+
+    def __init__(self):
+        self.http = get_http_session()
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._messages = deque()
+        self.completed = 0  # annotations enregistrées (version des données du tableau de bord)
+
+    def _post(self, path, payload):
+        for attempt in range(POST_RETRIES):
+            try:
+                res = self.http.post(f"{BACKEND_URL}{path}", json=payload, timeout=15)
+                if res.status_code < 500:
+                    return res
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.5 * 2 ** attempt)
+        return None
+
+    def _send(self, payload, vote, idempotency_key):
+        item = {k: v for k, v in payload.items() if k != "user_id"}
+        res = self._post("/annotations/batch", {
+            "user_id": payload["user_id"],
+            "items": [{**item, "vote": vote, "idempotency_key": idempotency_key}]
+        })
+        if res is None or not res.ok:
+            self._messages.append(("error", f"Erreur lors de l'annotation : {res.text if res is not None else 'serveur injoignable'}"))
+            return
+        result = res.json()["results"][0]
+        if result["status"] not in ("created", "duplicate"):
+            self._messages.append(("error", f"Erreur lors de l'annotation : {result['status']}"))
+            return
+        self.completed += 1
+        # "duplicate" : la première tentative a abouti, vote compris
+        vote_result = result.get("vote") or {}
+        if vote_result.get("status") == "forbidden":
+            self._messages.append(("warning", "⚠️ Votre fiabilité < 75%, votre vote n’a pas été compté."))
+        elif vote_result.get("status") == "invalid":
+            self._messages.append(("warning", "⚠️ Impossible d'enregistrer votre vote."))
+        elif "ground_truth" in vote_result:
+            self.completed += 1
+            self._messages.append(("validated", vote_result["ground_truth"]))
+
+    def submit(self, payload, vote):
+        # Clé fixée au clic, réutilisée par toutes les tentatives d'envoi
+        self._executor.submit(self._send, payload, vote, uuid.uuid4().hex)
+
+    def drain(self):
+        messages = []
+        while self._messages:
+            messages.append(self._messages.popleft())
+        return messages
 
 # --- Page setup ---
 st.set_page_config(page_title="Classification Poissons", layout="centered")
@@ -47,38 +257,44 @@ def fetch_new_image():
         st.warning("Identifiant utilisateur manquant.")
         return
 
-    try:
-        res = requests.get(f"{BACKEND_URL}/image?user_id={user_id}")
-        res.raise_for_status()
-        data = res.json()
-
-        img_b64 = data["image"]
-        img = Image.open(BytesIO(base64.b64decode(img_b64)))
-        st.session_state.img_to_display = img
-        st.session_state.img_id = data["image_id"]
-        st.session_state.is_test = data.get("is_test", False)
-        st.session_state.expected_label = data.get("expected_label")
+    prefetcher = st.session_state.get("prefetcher")
+    if prefetcher is None or prefetcher.user_id != user_id or prefetcher.stopped:
+        if prefetcher is not None:
+            prefetcher.stop()
+        prefetcher = st.session_state.prefetcher = ImagePrefetcher(user_id)
+    if prefetcher.exhausted:
+        prefetcher.refill()
 
-    except requests.exceptions.HTTPError as e:
+    data = prefetcher.next()
+    if data is None:
         st.session_state.img_to_display = None
         st.session_state.img_id = None
-        if res.status_code == 404:
+        if prefetcher.exhausted:
             st.info("🎉 Toutes les images ont été annotées ! Merci pour votre participation.")
         else:
-            st.error(f"Erreur serveur : {res.text}")
-    except Exception as e:
-        st.error(f"Erreur inattendue : {str(e)}")
+            st.error(f"Erreur serveur : {prefetcher.error or 'délai dépassé'}")
+        return
+
+    st.session_state.img_to_display = data["content"]
+    st.session_state.img_id = data["image_id"]
+    st.session_state.is_test = data.get("is_test", False)
+    st.session_state.expected_label = data.get("expected_label")
 
 
-# --- Fonction : charger les stats utilisateur ---
-def get_user_details(user_id):
+def get_annotation_sender():
+    if "annotation_sender" not in st.session_state:
+        st.session_state.annotation_sender = AnnotationSender()
+    return st.session_state.annotation_sender
+
+
+# --- Fonction : charger le tableau de bord de l'utilisateur ---
+def get_dashboard(user_id):
+    version = (get_annotation_sender().completed, st.session_state.get("reports_sent", 0))
     try:
-        res = requests.get(f"{BACKEND_URL}/user_details/{user_id}", timeout=5)
-        res.raise_for_status()
-        return res.json()
-    except requests.exceptions.RequestException as e:
-        st.warning("⚠️ Impossible de charger les stats utilisateur.")
-        return None
+        return fetch_dashboard(user_id, version)
+    except requests.exceptions.RequestException:
+        st.sidebar.warning("⚠️ Impossible de charger les stats utilisateur.")
+        return {}
 
 
 # --- Écran d’authentification ---
@@ -130,30 +346,62 @@ else:
     user_id = st.session_state.user_id
     st.sidebar.header(f"👤 {user_id}")
 
+    if st.sidebar.button("🚪 Se déconnecter", use_container_width=True):
+        prefetcher = st.session_state.pop("prefetcher", None)
+        if prefetcher is not None:
+            prefetcher.stop()
+        st.session_state.authenticated = False
+        st.session_state.user_id = None
+        st.session_state.img_to_display = None
+        st.session_state.img_id = None
+        st.rerun()
+
+    # Résultats des envois d'annotations / votes en arrière-plan
+    for kind, message in get_annotation_sender().drain():
+        if kind == "validated":
+            st.sidebar.subheader("Succès : ")
+            st.balloons()
+            st.sidebar.success(f"🎉 L'image a été validée : {message}")
+        elif kind == "warning":
+            st.warning(message)
+        else:
+            st.error(message)
+
+    dashboard = get_dashboard(user_id)
+
     if st.sidebar.button("📊 Comparer mes votes à l'IA", use_container_width=True):
         with st.spinner("Chargement des comparaisons..."):
             try:
-                res = requests.get(f"{BACKEND_URL}/comparison?user_id={user_id}")
-                data = res.json()
-                comparison_data = data.get("results", [])
-
-                if not comparison_data:
-                    st.warning("Aucune comparaison disponible.")
-
-                # Préparation des données pour affichage
+                # Lignes reçues au fil de l'eau (NDJSON), tableau rafraîchi par paquets
+                import pandas as pd
+                res = get_http_session().get(
+                    f"{BACKEND_URL}/comparison",
+                    params={"user_id": user_id, "format": "ndjson"},
+                    stream=True,
+                    timeout=30
+                )
+                res.raise_for_status()
+                placeholder = st.empty()
                 table = []
 
-                for item in comparison_data:
+                for line in res.iter_lines():
+                    if not line:
+                        continue
+                    item = json.loads(line)
                     table.append({
                         "Image ID": item["image_id"],
                         "Attendu": item["attendu"] or "",
                         "Utilisateur": item["utilisateur"] or "",
                         "IA": item["ia"] or ""
                     })
-                # Affichage du tableau
-                import pandas as pd
-                df = pd.DataFrame(table)
-                st.dataframe(df, hide_index=True)
+                    if len(table) % COMPARISON_CHUNK == 0:
+                        placeholder.dataframe(pd.DataFrame(table), hide_index=True)
+
+                if not table:
+                    st.warning("Aucune comparaison disponible.")
+                else:
+                    # Affichage du tableau
+                    placeholder.dataframe(pd.DataFrame(table), hide_index=True)
 
             except Exception as e:
                 st.error(f"Erreur lors de la récupération des comparaisons : {str(e)}")
@@ -162,9 +410,7 @@ else:
     st.sidebar.subheader("🏆 Top Annotateurs")
 
     try:
-        res = requests.get(f"{BACKEND_URL}/leaderboard", params={"user_id": user_id})
-        res.raise_for_status()
-        data = res.json()
+        data = dashboard["leaderboard"]
 
         top_users = data.get("top_users", [])
         user_rank = data.get("user_rank", None)
@@ -187,7 +433,7 @@ else:
 
 
     try:
-        ai_stats = requests.get(f"{BACKEND_URL}/ai-stats?user_id={user_id}").json()
+        ai_stats = dashboard["ai_stats"]
 
         st.sidebar.subheader("Performance :")
 
@@ -217,7 +463,7 @@ else:
 
     # Charger les stats utilisateur si pas encore fait
     if 'user_initialized' not in st.session_state:
-        details = get_user_details(user_id)
+        details = dashboard.get("user_details")
         if details:
             test_annotations = details.get("test_annotations", 0)
             test_correct = details.get("test_correct", 0)
@@ -230,11 +476,7 @@ else:
         st.session_state.user_initialized = True
 
     # Stats utilisateurs
-    try:
-        stats = requests.get(f"{BACKEND_URL}/stats?user_id={user_id}").json()
-        remaining = stats.get("remaining_images", "?")
-    except:
-        remaining = "?"
+    remaining = dashboard.get("remaining_images", "?")
 
     col1, col2 = st.columns([3, 1])
     with col1:
@@ -258,6 +500,7 @@ else:
                         fetch_new_image()
                         st.rerun()
                     elif r.ok:
+                        st.session_state.reports_sent = st.session_state.get("reports_sent", 0) + 1
                         msg = r.json().get("message", "Signalement pris en compte.")
                         st.success(msg)
                         fetch_new_image()
@@ -286,41 +529,19 @@ else:
                         "expected_label": st.session_state.expected_label
                     }
 
-                    r = requests.post(f"{BACKEND_URL}/annotations", json=payload)
-                    if r.ok:
-                        st.success(f"Annotation '{chosen}' enregistrée !")
-
-                        if st.session_state.is_test:
-                            correct = chosen == st.session_state.expected_label
-                            st.session_state.test_results.append(correct)
-                            accuracy = sum(st.session_state.test_results) / len(st.session_state.test_results)
-                            st.session_state.user_accuracy = accuracy
-                            st.info(f"{'✅ Bonne réponse' if correct else '❌ Mauvaise réponse'} | Score actuel : {int(accuracy * 100)}%")
-
-                        if not st.session_state.is_test:
-                            try:
-                                res_vote = requests.post(f"{BACKEND_URL}/vote_annotation", json={
-                                    "image_id": st.session_state.img_id,
-                                    "user_id": user_id,
-                                    "label": chosen
-                                })
-
-                                if res_vote.status_code == 403:
-                                    st.warning("⚠️ Votre fiabilité < 75%, votre vote n’a pas été compté.")
-                                elif res_vote.ok:
-                                    vote_data = res_vote.json()
-                                    if "ground_truth" in vote_data:
-                                        st.sidebar.subheader("Succès : ")
-                                        st.balloons()
-                                        st.sidebar.success(f"🎉 L'image a été validée : {vote_data['ground_truth']}")
-
-                            except Exception as e:
-                                st.warning("⚠️ Impossible d'enregistrer votre vote.")
+                    # Envoi en arrière-plan : l'image suivante (déjà préchargée) s'affiche tout de suite
+                    get_annotation_sender().submit(payload, vote=not st.session_state.is_test)
+                    st.success(f"Annotation '{chosen}' enregistrée !")
 
-                        fetch_new_image()
-                        st.rerun()
-                    else:
-                        st.error(f"Erreur lors de l'annotation : {r.text}")
+                    if st.session_state.is_test:
+                        correct = chosen == st.session_state.expected_label
+                        st.session_state.test_results.append(correct)
+                        accuracy = sum(st.session_state.test_results) / len(st.session_state.test_results)
+                        st.session_state.user_accuracy = accuracy
+                        st.info(f"{'✅ Bonne réponse' if correct else '❌ Mauvaise réponse'} | Score actuel : {int(accuracy * 100)}%")
+
+                    fetch_new_image()
+                    st.rerun()
         # if st.button("✅ Soumettre annotation", use_container_width=True):
         #     payload = {
         #         "image_id": st.session_state.img_id,
@@ -1,9 +1,18 @@
 # mongo_setup.py
 
+import argparse
+import hashlib
 import os
-from pymongo import MongoClient
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from bson.binary import Binary
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import gridfs
 from dotenv import load_dotenv
+from PIL import Image, ImageOps
 
 load_dotenv()
 
@@ -15,28 +24,446 @@ VALID_LABELS = {"ABL", "ALA", "ANG", "BAF", "BRE", "CHE", "HOT", "SIL"}
 
 local_folder = "images_to_classify"
 
-for fname in os.listdir(local_folder):
-    if not fname.lower().endswith((".jpg", ".jpeg", ".png")):
-        continue
+# --- Dérivés générés à l'ingestion ---
+DISPLAY_MAX_SIZE = int(os.getenv("DISPLAY_MAX_SIZE", "1024"))  # plus grand côté, affichage Streamlit
+INFERENCE_SIZE = int(os.getenv("INFERENCE_SIZE", "224"))  # plus petit côté, entrée YOLO (imgsz)
 
-    path = os.path.join(local_folder, fname)
+# --- Stockage hybride : BinData dans le document sous ce seuil, GridFS au-delà ---
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(512 * 1024)))
+STORAGE_FIELDS = {
+    # variante : (identifiant GridFS, octets inline, suffixe du nom de fichier, type MIME)
+    "original": ("file_id", "data", "", None),
+    "display": ("display_file_id", "display_data", ".display.webp", "image/webp"),
+    "inference": ("inference_file_id", "inference_data", ".inference.jpg", "image/jpeg"),
+}
 
+
+def make_derivatives(data: bytes):
+    """
+    Construit les variantes d'une image :
+    - affichage : WebP dont le plus grand côté vaut DISPLAY_MAX_SIZE
+    - inférence : JPEG dont le plus petit côté vaut INFERENCE_SIZE (YOLO recadre ensuite au centre)
+    """
+    img = ImageOps.exif_transpose(Image.open(BytesIO(data))).convert("RGB")
+
+    display = img.copy()
+    display.thumbnail((DISPLAY_MAX_SIZE, DISPLAY_MAX_SIZE), Image.LANCZOS)
+    display_buf = BytesIO()
+    display.save(display_buf, format="WEBP", quality=85, method=4)
+
+    scale = INFERENCE_SIZE / min(img.size)
+    inference = img
+    if scale < 1:
+        inference = img.resize(
+            (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+            Image.BILINEAR
+        )
+    inference_buf = BytesIO()
+    inference.save(inference_buf, format="JPEG", quality=95)
+
+    return display_buf.getvalue(), inference_buf.getvalue()
+
+
+def gridfs_filename(variant: str, fname: str) -> str:
+    suffix = STORAGE_FIELDS[variant][2]
+    return f"{os.path.splitext(fname)[0]}{suffix}" if suffix else fname
+
+
+def put_gridfs(variant: str, data: bytes, fname: str):
+    content_type = STORAGE_FIELDS[variant][3]
+    kwargs = {"contentType": content_type} if content_type else {}
+    return fs.put(data, filename=gridfs_filename(variant, fname), **kwargs)
+
+
+def store_payload(variant: str, data: bytes, fname: str, max_inline: int = INLINE_MAX_BYTES):
+    """
+    Stocke une variante : inline (BinData) si elle est petite, sinon dans GridFS.
+    Renvoie le champ à enregistrer dans le document image.
+    """
+    file_key, data_key, _, _ = STORAGE_FIELDS[variant]
+    if len(data) < max_inline:
+        return {data_key: Binary(data)}
+    return {file_key: put_gridfs(variant, data, fname)}
+
+
+def delete_stored(fields: dict):
+    """
+    Supprime les fichiers GridFS référencés par des champs de variantes jamais
+    liés à un document (envoi ou insertion en échec). Les octets inline n'ont
+    pas d'existence hors du document : rien à supprimer.
+    """
+    for file_key, _, _, _ in STORAGE_FIELDS.values():
+        if fields.get(file_key):
+            try:
+                fs.delete(fields[file_key])
+            except gridfs.errors.NoFile:
+                pass
+
+
+def read_original(img: dict) -> bytes:
+    if img.get("data") is not None:
+        return bytes(img["data"])
+    return fs.get(img["file_id"]).read()
+
+
+def reserve_ordinals(n: int):
+    """
+    Réserve n ordinaux séquentiels (utilisés par l'index des images vues du backend)
+    et renvoie le premier.
+    """
+    counter = db["counters"].find_one_and_update(
+        {"_id": "image_ordinal"},
+        {"$inc": {"seq": n}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - n
+
+
+# --- Empreintes : doublons exacts (SHA-256) et quasi-doublons (dHash) ---
+DHASH_BITS = 64
+DHASH_BANDS = 8  # 8 bandes de 8 bits : tout voisin à ≤ 7 bits partage au moins une bande
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "6"))
+
+
+def dhash(img: Image.Image) -> int:
+    """
+    Hash perceptuel par différence (9x8 niveaux de gris, 64 bits) : stable au
+    redimensionnement et à la recompression.
+    """
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+class NearDuplicateIndex:
+    """
+    Index multi-bandes des dHash : les candidats partagent une bande de 8 bits,
+    la distance de Hamming n'est calculée que pour eux.
+    """
+
+    def __init__(self, max_distance: int = NEAR_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self.bands = [{} for _ in range(DHASH_BANDS)]
+
+    def _keys(self, h: int):
+        width = DHASH_BITS // DHASH_BANDS
+        return [(h >> (i * width)) & ((1 << width) - 1) for i in range(DHASH_BANDS)]
+
+    def add(self, h: int):
+        for band, key in zip(self.bands, self._keys(h)):
+            band.setdefault(key, []).append(h)
+
+    def discard(self, h: int):
+        for band, key in zip(self.bands, self._keys(h)):
+            if h in band.get(key, ()):
+                band[key].remove(h)
+
+    def find(self, h: int):
+        for band, key in zip(self.bands, self._keys(h)):
+            for other in band.get(key, ()):
+                if bin(h ^ other).count("1") <= self.max_distance:
+                    return other
+        return None
+
+
+def fingerprint(path: str):
+    """
+    Lecture et empreintes d'un fichier (exécuté dans le pool de threads).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    with Image.open(BytesIO(data)) as img:
+        phash = dhash(ImageOps.exif_transpose(img))
+    return data, hashlib.sha256(data).hexdigest(), phash
+
+
+def upload(fname: str, data: bytes):
+    """
+    Stocke l'original et ses variantes, inline ou dans GridFS (exécuté dans le pool de threads).
+    En cas d'échec, les fichiers déjà envoyés sont supprimés.
+    """
+    display_b, inference_b = make_derivatives(data)
+    fields = {}
+    try:
+        for variant, payload in (("original", data), ("display", display_b), ("inference", inference_b)):
+            fields.update(store_payload(variant, payload, fname))
+    except Exception:
+        delete_stored(fields)
+        raise
+    return fields
+
+
+def label_from_filename(fname: str):
     # ⬇️ Extraction automatique du label à partir du nom de fichier
     base_name = os.path.splitext(fname)[0]  # enlève l'extension
-    parts = base_name.split("_")
-    label_candidate = parts[0].upper()
-    ground_truth = label_candidate if label_candidate in VALID_LABELS else None
+    label_candidate = base_name.split("_")[0].upper()
+    return label_candidate if label_candidate in VALID_LABELS else None
 
-    with open(path, "rb") as f:
-        file_id = fs.put(f, filename=fname)
-
-    doc = {
-        "file_id": file_id,
-        "filename": fname,
-        "ground_truth": ground_truth,  # ✅ Défini automatiquement
-        "validated": False,
-        "annotations_count": 0
-    }
-
-    images_col.insert_one(doc)
-    print(f"Uploadé {fname} → ground_truth={ground_truth}")
\ No newline at end of file
+
+class IngestCheckpoint:
+    """
+    Fichiers déjà traités (importés ou écartés comme doublons), une ligne par
+    fichier : une relance ne traite que les nouveaux fichiers.
+    """
+
+    def __init__(self, path: str, reset: bool = False):
+        self.path = path
+        self.done = set()
+        if reset and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+
+    def record(self, fnames):
+        with open(self.path, "a") as f:
+            for fname in fnames:
+                f.write(fname + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(fnames)
+
+
+def load_known_hashes():
+    """
+    Empreintes des images déjà en base (reprise, ou dossier ajouté à une base existante).
+    """
+    sha256s, near = set(), NearDuplicateIndex()
+    for img in images_col.find({"sha256": {"$exists": True}}, {"sha256": 1, "phash": 1}):
+        sha256s.add(img["sha256"])
+        if img.get("phash"):
+            near.add(int(img["phash"], 16))
+    return sha256s, near
+
+
+def ingest(workers: int, chunk_size: int, checkpoint_path: str, reset: bool):
+    images_col.create_index("sha256", unique=True, sparse=True)
+    checkpoint = IngestCheckpoint(checkpoint_path, reset)
+    sha256s, near = load_known_hashes()
+
+    fnames = sorted(
+        fname for fname in os.listdir(local_folder)
+        if fname.lower().endswith((".jpg", ".jpeg", ".png")) and fname not in checkpoint.done
+    )
+    print(f"{len(fnames)} fichier(s) à traiter ({len(checkpoint.done)} déjà traités)")
+
+    stats = {"files": 0, "bytes": 0, "inserted": 0, "exact": 0, "near": 0, "errors": 0}
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(fnames), chunk_size):
+            chunk = fnames[i:i + chunk_size]
+
+            # 1. Lecture et empreintes en parallèle
+            prints = list(pool.map(
+                lambda fname: _safe(fingerprint, os.path.join(local_folder, fname)), chunk
+            ))
+
+            # 2. Décision de dédoublonnage (séquentielle : index partagé)
+            accepted, done = [], []
+            for fname, fp in zip(chunk, prints):
+                if fp is None:
+                    stats["errors"] += 1
+                    continue
+                data, sha, phash = fp
+                stats["files"] += 1
+                stats["bytes"] += len(data)
+                if sha in sha256s:
+                    stats["exact"] += 1
+                    done.append(fname)
+                    continue
+                match = near.find(phash)
+                if match is not None:
+                    stats["near"] += 1
+                    done.append(fname)
+                    print(f"Quasi-doublon ignoré : {fname} (dHash {phash:016x} ≈ {match:016x})")
+                    continue
+                sha256s.add(sha)
+                near.add(phash)
+                accepted.append((fname, data, sha, phash))
+
+            # 3. Envoi GridFS en parallèle, puis métadonnées en un insert_many
+            uploads = list(pool.map(lambda item: _safe(upload, item[0], item[1]), accepted))
+            docs = []
+            for (fname, _, sha, phash), fields in zip(accepted, uploads):
+                if fields is None:
+                    # Échec d'envoi : non enregistré au point de reprise, retenté à la prochaine exécution
+                    stats["errors"] += 1
+                    sha256s.discard(sha)
+                    near.discard(phash)
+                else:
+                    docs.append((fname, sha, phash, fields))
+            if docs:
+                first = reserve_ordinals(len(docs))
+                batch = [{
+                    **fields,
+                    "filename": fname,
+                    "ground_truth": label_from_filename(fname),  # ✅ Défini automatiquement
+                    "validated": False,
+                    "annotations_count": 0,
+                    "ordinal": first + n,
+                    "rand": random.random(),  # clé de tirage aléatoire indexée
+                    "sha256": sha,
+                    "phash": f"{phash:016x}",
+                } for n, (fname, sha, phash, fields) in enumerate(docs)]
+                failed = {}
+                try:
+                    images_col.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    failed = {err["index"]: err.get("code") for err in e.details.get("writeErrors", [])}
+                for n, (fname, sha, phash, fields) in enumerate(docs):
+                    if n not in failed:
+                        done.append(fname)
+                        continue
+                    # Document refusé : ses fichiers GridFS ne seraient référencés par rien
+                    delete_stored(fields)
+                    if failed[n] == 11000:
+                        # Doublon exact inséré par une exécution concurrente : ignoré
+                        stats["exact"] += 1
+                        done.append(fname)
+                    else:
+                        stats["errors"] += 1
+                        sha256s.discard(sha)
+                        near.discard(phash)
+                inserted = len(batch) - len(failed)
+                stats["inserted"] += inserted
+                # Images restantes du backend (compteur créé au démarrage de l'API s'il manque)
+                db["counters"].update_one({"_id": "open_images"}, {"$inc": {"n": inserted}})
+
+            checkpoint.record(done)
+
+            elapsed = time.perf_counter() - t0
+            print(f"{stats['files']} fichiers ({stats['inserted']} importés, {stats['exact']} doublons, "
+                  f"{stats['near']} quasi-doublons) — {stats['files'] / elapsed:.1f} fichiers/s, "
+                  f"{stats['bytes'] / elapsed / 1e6:.1f} Mo/s")
+
+    elapsed = time.perf_counter() - t0
+    print(f"✅ Terminé en {elapsed:.1f} s : {stats}")
+
+
+def _safe(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as e:
+        print(f"⚠️ {args[0]} : {e}")
+        return None
+
+
+def backfill():
+    """
+    Génère les variantes et empreintes manquantes des images déjà en base.
+    """
+    images_col.create_index("sha256", unique=True, sparse=True)
+    query = {"$or": [
+        {"display_file_id": {"$exists": False}, "display_data": {"$exists": False}},
+        {"inference_file_id": {"$exists": False}, "inference_data": {"$exists": False}},
+        {"sha256": {"$exists": False}},
+    ]}
+    projection = {"file_id": 1, "data": 1, "filename": 1, "display_file_id": 1, "inference_file_id": 1,
+                  "display_data": {"$type": "$display_data"}, "inference_data": {"$type": "$inference_data"},
+                  "sha256": 1}
+    for img in images_col.find(query, projection):
+        try:
+            data = read_original(img)
+        except gridfs.errors.NoFile:
+            print(f"⚠️ Fichier introuvable pour {img['_id']}, ignoré")
+            continue
+        fields = {}
+        has_display = "display_file_id" in img or img.get("display_data") != "missing"
+        has_inference = "inference_file_id" in img or img.get("inference_data") != "missing"
+        if not (has_display and has_inference):
+            # Seules les variantes absentes sont stockées : une variante déjà liée
+            # n'est jamais remplacée (son fichier GridFS deviendrait orphelin)
+            fname = img.get("filename") or str(img["_id"])
+            display_b, inference_b = make_derivatives(data)
+            if not has_display:
+                fields.update(store_payload("display", display_b, fname))
+            if not has_inference:
+                fields.update(store_payload("inference", inference_b, fname))
+        if "sha256" not in img:
+            with Image.open(BytesIO(data)) as pil:
+                fields["phash"] = f"{dhash(ImageOps.exif_transpose(pil)):016x}"
+            fields["sha256"] = hashlib.sha256(data).hexdigest()
+        try:
+            try:
+                images_col.update_one({"_id": img["_id"]}, {"$set": fields})
+            except DuplicateKeyError:
+                # Doublon exact d'une image déjà en base : on garde les variantes, sans empreinte
+                fields.pop("sha256")
+                images_col.update_one({"_id": img["_id"]}, {"$set": fields})
+                print(f"⚠️ {img.get('filename')} est un doublon exact d'une autre image")
+        except Exception:
+            delete_stored(fields)
+            raise
+        print(f"Variantes / empreintes générées pour {img.get('filename')}")
+
+
+def migrate_storage(target: str, max_inline: int):
+    """
+    Déplace les contenus existants entre les deux modes de stockage :
+    - inline : fichiers GridFS plus petits que max_inline → BinData du document
+    - gridfs : BinData d'au moins max_inline octets → GridFS (0 = tout)
+    Le document est mis à jour avant la suppression de l'ancienne copie.
+    """
+    moved = moved_bytes = 0
+    for variant, (file_key, data_key, _, _) in STORAGE_FIELDS.items():
+        if target == "inline":
+            for img in images_col.find({file_key: {"$exists": True}}, {file_key: 1}):
+                try:
+                    grid_out = fs.get(img[file_key])
+                except gridfs.errors.NoFile:
+                    print(f"⚠️ Fichier introuvable pour {img['_id']} ({variant}), ignoré")
+                    continue
+                if grid_out.length >= max_inline:
+                    continue
+                data = grid_out.read()
+                result = images_col.update_one(
+                    {"_id": img["_id"], file_key: img[file_key]},
+                    {"$set": {data_key: Binary(data)}, "$unset": {file_key: ""}}
+                )
+                if result.modified_count:
+                    fs.delete(img[file_key])
+                    moved += 1
+                    moved_bytes += len(data)
+        else:
+            for img in images_col.find({data_key: {"$exists": True}}, {data_key: 1, "filename": 1}):
+                data = bytes(img[data_key])
+                if len(data) < max_inline:
+                    continue
+                file_id = put_gridfs(variant, data, img.get("filename") or str(img["_id"]))
+                result = images_col.update_one(
+                    {"_id": img["_id"], data_key: {"$exists": True}},
+                    {"$set": {file_key: file_id}, "$unset": {data_key: ""}}
+                )
+                if result.modified_count:
+                    moved += 1
+                    moved_bytes += len(data)
+                else:
+                    fs.delete(file_id)
+        print(f"{variant} : {moved} contenu(s) déplacé(s) au total")
+    print(f"✅ Migration vers {target} : {moved} contenus, {moved_bytes / 1e6:.1f} Mo")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingestion des images dans MongoDB/GridFS")
+    parser.add_argument("--backfill", action="store_true", help="Génère les variantes et empreintes des images existantes")
+    parser.add_argument("--workers", type=int, default=8, help="Threads de lecture / envoi GridFS")
+    parser.add_argument("--chunk-size", type=int, default=200, help="Fichiers traités par lot")
+    parser.add_argument("--checkpoint", default="ingest_checkpoint.txt")
+    parser.add_argument("--reset", action="store_true", help="Ignore le point de reprise existant")
+    parser.add_argument("--migrate-storage", choices=["inline", "gridfs"],
+                        help="Déplace les contenus existants vers le document (inline) ou GridFS")
+    parser.add_argument("--inline-max-bytes", type=int, default=INLINE_MAX_BYTES,
+                        help="Seuil du stockage inline pour --migrate-storage")
+    args = parser.parse_args()
+
+    if args.migrate_storage:
+        migrate_storage(args.migrate_storage, args.inline_max_bytes)
+    elif args.backfill:
+        backfill()
+    else:
+        ingest(args.workers, args.chunk_size, args.checkpoint, args.reset)
@@ -0,0 +1,85 @@
+# reconcile_votes.py
+#
+# Reconstruit le décompte des votes porté par chaque image (vote_total,
+# vote_weights.<espèce>) à partir de la collection votes.
+#
+#   python reconcile_votes.py             # corrige les décomptes divergents
+#   python reconcile_votes.py --dry-run   # affiche les écarts sans écrire
+#
+# Les décomptes sont remplacés ($set) : à lancer quand aucun vote n'est en cours.
+# Les images sont parcourues par pages (ordre des _id) ; les votes de chaque page
+# sont agrégés via l'index (image_id, user_id) : rien n'est chargé en entier.
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+load_dotenv()
+
+client = MongoClient(os.getenv("ATLAS_URI"))
+db = client[os.getenv("DB_NAME")]
+images_col = db["images"]
+votes_col = db["votes"]
+
+TOLERANCE = 1e-9
+PAGE_SIZE = 1000
+
+
+def expected_tallies(image_ids):
+    """
+    Somme des poids par espèce pour une page d'images, calculée par le serveur.
+    """
+    tallies = {}
+    pipeline = [
+        {"$match": {"image_id": {"$in": image_ids}}},
+        {"$group": {"_id": {"image_id": "$image_id", "label": "$label"}, "weight": {"$sum": "$weight"}}},
+    ]
+    for row in votes_col.aggregate(pipeline):
+        tallies.setdefault(row["_id"]["image_id"], {})[row["_id"]["label"]] = row["weight"]
+    return tallies
+
+
+def differs(doc, weights):
+    current = doc.get("vote_weights") or {}
+    if set(current) != set(weights):
+        return True
+    if abs((doc.get("vote_total") or 0) - sum(weights.values())) > TOLERANCE:
+        return True
+    return any(abs(current[label] - w) > TOLERANCE for label, w in weights.items())
+
+
+def reconcile(dry_run: bool, page_size: int = PAGE_SIZE):
+    fixed = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        page = list(images_col.find(query, {"vote_total": 1, "vote_weights": 1}).sort("_id", 1).limit(page_size))
+        if not page:
+            break
+        last_id = page[-1]["_id"]
+        tallies = expected_tallies([str(doc["_id"]) for doc in page])
+
+        ops = []
+        for doc in page:
+            weights = tallies.get(str(doc["_id"]), {})
+            if not differs(doc, weights):
+                continue
+            print(f"{doc['_id']} : {doc.get('vote_total') or 0:.3f} → {sum(weights.values()):.3f}")
+            ops.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"vote_total": sum(weights.values()), "vote_weights": weights}}
+            ))
+        if ops and not dry_run:
+            images_col.bulk_write(ops, ordered=False)
+        fixed += len(ops)
+    print(f"{fixed} décompte(s) {'à corriger' if dry_run else 'corrigé(s)'}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruit les décomptes de votes des images")
+    parser.add_argument("--dry-run", action="store_true", help="Affiche les écarts sans les corriger")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Images vérifiées par requête")
+    args = parser.parse_args()
+    reconcile(args.dry_run, args.page_size)